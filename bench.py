@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+
+"""Benchmarks for syg, run against a local stand-in for the GitHub API.
+
+    python3 bench.py [--latency MS] [--quick] [scenario ...]
+
+Each scenario reports wall time, the number of requests and bytes the fake
+server answered, and syg's peak memory (from tracemalloc), and fails (exit
+status 1) if any of them is over its budget in BUDGETS.
+"""
+
+import sys, io, json, time, base64, hashlib, tarfile, tempfile, threading, argparse
+import tracemalloc, urllib.parse, http.server, collections
+import syg
+
+#######################################################################
+# Synthetic repositories
+#######################################################################
+
+CONTROL = (b"Source: example\nBuild-Depends: debhelper (>= 9), libfoo-dev | libfoo2-dev,\n"
+    b" cmake, pkg-config\nBuild-Depends-Indep: python3-sphinx\n")
+
+def blob_sha(content):
+    return hashlib.sha1(b"blob %d\0" % (len(content),) + content).hexdigest()
+
+class SyntheticRepo(object):
+    def __init__(self, owner, name, files, tag="1.0"):
+        self.owner = owner
+        self.name = name
+        self.tag = tag
+        self.files = files
+        self.dirs = set([""])
+        for path in files:
+            parts = path.split("/")
+            for n in range(1, len(parts)):
+                self.dirs.add("/".join(parts[:n]))
+
+def tiny(owner="bench", name="tiny"):
+    return SyntheticRepo(owner, name, {"Makefile": b"all:\n", "README.md": b"tiny\n"})
+
+def typical(owner="bench", name="typical"):
+    files = {"CMakeLists.txt": b"project(x)\n", "README.md": b"hi\n",
+        "requirements.txt": b"requests\n", "debian/control": CONTROL,
+        "debian/rules": b"%:\n\tdh $@\n", "debian/changelog": b"x (1.0) unstable\n"}
+    for d in range(10):
+        for f in range(30):
+            files["src/mod%d/file%d.c" % (d, f)] = b"int f%d;\n" % (f,)
+    return SyntheticRepo(owner, name, files)
+
+def monorepo(owner="bench", name="monorepo"):
+    files = {"Makefile": b"all:\n", "debian/control": CONTROL}
+    for a in range(100):
+        for b in range(10):
+            for c in range(100):
+                files["pkg%d/sub%d/f%d.c" % (a, b, c)] = b""
+    return SyntheticRepo(owner, name, files)
+
+def monorepo_parts(owner="bench", name="monorepo-parts"):
+    files = monorepo(owner, name).files
+    del files["Makefile"]
+    for a in range(0, 100, 10):
+        files["pkg%d/CMakeLists.txt" % (a,)] = b"project(x)\n"
+        files["pkg%d/sub%d/CMakeLists.txt" % (a, a % 10)] = b"add_library(x)\n"
+        files["pkg%d/sub1/requirements.txt" % (a + 1,)] = b"requests\n"
+    return SyntheticRepo(owner, name, files)
+
+def deep_debian(owner="bench", name="deep-debian"):
+    files = {"configure.ac": b"AC_INIT\n", "debian/control": CONTROL}
+    for n in range(2000):
+        files["debian/patches/%s/%04d.patch" % ("/".join("d%d" % i for i in range(n % 12)), n)] = b"--\n"
+    return SyntheticRepo(owner, name, files)
+
+
+#######################################################################
+# The fake GitHub
+#######################################################################
+
+class FakeGitHub(object):
+    """Answers the REST calls syg makes, for a set of SyntheticRepos, after
+       an injected delay. Like GitHub, responses carry an ETag (and a matching
+       If-None-Match gets a 304), and recursive tree listings of more than
+       TRUNCATE_AT entries are cut short and marked truncated."""
+    TRUNCATE_AT = 100000
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.repos = {}
+        self.rendered = {}
+        self.lock = threading.Lock()
+        self.reset_counts()
+        fake = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_GET(self):
+                fake.handle(self)
+            def log_message(self, *args):
+                pass
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % (self.server.server_address[1],)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counts(self):
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes = 0
+
+    def add(self, repo):
+        self.repos[(repo.owner, repo.name)] = repo
+        return "https://github.com/%s/%s" % (repo.owner, repo.name)
+
+    def handle(self, request):
+        time.sleep(self.latency)
+        url = urllib.parse.urlsplit(request.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.split("/", 5)
+        status, body = 404, {"message": "Not Found"}
+        repo = self.repos.get(tuple(parts[2:4])) if len(parts) >= 4 and parts[1] == "repos" else None
+        if repo:
+            rest = "/".join(parts[4:])
+            key = (repo.owner, repo.name, rest, url.query)
+            with self.lock:
+                rendered = self.rendered.get(key)
+            if rendered is None:
+                status, body = self.route(repo, rest, query)
+                rendered = (status, body if isinstance(body, bytes) else json.dumps(body).encode("utf-8"))
+                with self.lock:
+                    self.rendered[key] = rendered
+            status, body = rendered
+        elif not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        etag = '"%s"' % (hashlib.sha1(body).hexdigest()[:16],)
+        if status == 200 and request.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(body)
+            if status == 304: self.not_modified += 1
+        request.send_response(status)
+        request.send_header("Content-Length", str(len(body)))
+        request.send_header("Content-Type", "application/json")
+        if status in (200, 304): request.send_header("ETag", etag)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def route(self, repo, rest, query):
+        base = "%s/repos/%s/%s" % (self.url, repo.owner, repo.name)
+        if rest == "":
+            return 200, {"name": repo.name, "description": "synthetic %s" % (repo.name,),
+                "default_branch": "main", "clone_url": "https://github.com/%s/%s.git" % (repo.owner, repo.name),
+                "trees_url": base + "/git/trees{/sha}", "releases_url": base + "/releases{/id}",
+                "archive_url": base + "/{archive_format}{/ref}"}
+        if rest == "releases/latest":
+            return 200, {"tag_name": repo.tag}
+        if rest.startswith("git/trees/"):
+            sha = urllib.parse.unquote(rest[len("git/trees/"):])
+            folder = "" if sha == "main" else sha
+            if folder not in repo.dirs: return 404, {"message": "Not Found"}
+            return 200, self.listing(repo, base, folder, "recursive" in query)
+        if rest.startswith("git/blobs/"):
+            sha = rest[len("git/blobs/"):]
+            for content in repo.files.values():
+                if blob_sha(content) == sha:
+                    return 200, {"sha": sha, "encoding": "base64",
+                        "content": base64.b64encode(content).decode("ascii")}
+            return 404, {"message": "Not Found"}
+        if rest.startswith("contents/"):
+            content = repo.files.get(rest[len("contents/"):])
+            if content is None: return 404, {"message": "Not Found"}
+            return 200, {"encoding": "base64", "content": base64.b64encode(content).decode("ascii")}
+        if rest == "tarball":
+            data = io.BytesIO()
+            with tarfile.open(fileobj=data, mode="w:gz") as tar:
+                top = "%s-%s-0000000/" % (repo.owner, repo.name)
+                for folder in sorted(repo.dirs):
+                    info = tarfile.TarInfo((top + folder).rstrip("/"))
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                for path, content in sorted(repo.files.items()):
+                    info = tarfile.TarInfo(top + path)
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+            return 200, data.getvalue()
+        return 404, {"message": "Not Found"}
+
+    def listing(self, repo, base, folder, recursive):
+        prefix = folder + "/" if folder else ""
+        entries = []
+        for d in sorted(repo.dirs):
+            if d and d.startswith(prefix) and (recursive or "/" not in d[len(prefix):]):
+                entries.append({"path": d[len(prefix):], "type": "tree", "mode": "040000",
+                    "sha": d, "url": base + "/git/trees/" + urllib.parse.quote(d, safe="")})
+        for path, content in sorted(repo.files.items()):
+            if path.startswith(prefix) and (recursive or "/" not in path[len(prefix):]):
+                entries.append({"path": path[len(prefix):], "type": "blob", "mode": "100644",
+                    "sha": blob_sha(content), "size": len(content),
+                    "url": base + "/git/blobs/" + blob_sha(content)})
+        truncated = recursive and len(entries) > self.TRUNCATE_AT
+        return {"sha": folder or "main", "tree": entries[:self.TRUNCATE_AT] if truncated else entries,
+            "truncated": truncated}
+
+
+#######################################################################
+# Scenarios
+#######################################################################
+
+# name -> (description, function(fake) returning a function to time)
+SCENARIOS = collections.OrderedDict()
+
+def scenario(name, description, slow=False):
+    def register(fn):
+        SCENARIOS[name] = (description, fn, slow)
+        return fn
+    return register
+
+def single(fake, repo, backend="api"):
+    repourl = fake.add(repo)
+    def run():
+        client = syg.Client()
+        return syg.process_one(repourl, client, backend)
+    return run
+
+@scenario("tiny", "one tiny repository")
+def bench_tiny(fake):
+    return single(fake, tiny())
+
+@scenario("typical", "one typical repository with debian/control")
+def bench_typical(fake):
+    return single(fake, typical())
+
+@scenario("typical-archive", "one typical repository, fetched as a tarball")
+def bench_typical_archive(fake):
+    return single(fake, typical(name="typical-archive"), "archive")
+
+@scenario("deep-debian", "a repository with a deep debian/ tree")
+def bench_deep_debian(fake):
+    return single(fake, deep_debian())
+
+@scenario("monorepo", "a 100k-file monorepo, whose tree listing gets truncated", slow=True)
+def bench_monorepo(fake):
+    return single(fake, monorepo())
+
+@scenario("monorepo-parts", "the same monorepo with 20 nested build roots, as separate parts",
+    slow=True)
+def bench_monorepo_parts(fake):
+    return single(fake, monorepo_parts(), "monorepo")
+
+@scenario("batch", "a batch of 50 typical repositories on 8 workers")
+def bench_batch(fake):
+    repourls = [fake.add(typical("batch", "repo%d" % (n,))) for n in range(50)]
+    def run():
+        results = syg.process_batch(repourls, tempfile.mkdtemp(), workers=8)
+        failed = [r for r in results if not r[1]]
+        if failed: raise Exception("batch failed: %s" % (failed[0],))
+    return run
+
+# Regression budgets, at the default latency. Request counts are exact
+# expectations; time and memory have headroom for slow machines.
+BUDGETS = {
+    "tiny": {"requests": 3, "seconds": 2, "peak_mb": 5},
+    "typical": {"requests": 4, "seconds": 2, "peak_mb": 10},
+    "typical-archive": {"requests": 3, "seconds": 2, "peak_mb": 10},
+    "deep-debian": {"requests": 4, "seconds": 3, "peak_mb": 20},
+    "monorepo": {"requests": 106, "seconds": 60, "peak_mb": 250},
+    "monorepo-parts": {"requests": 106, "seconds": 60, "peak_mb": 20},
+    "batch": {"requests": 151, "seconds": 10, "peak_mb": 40},
+}
+
+def measure(fake, name):
+    description, setup, slow = SCENARIOS[name]
+    run = setup(fake)
+    run() # warm up, so the fake server has rendered its responses
+    fake.reset_counts()
+    tracemalloc.start()
+    started = time.time()
+    run()
+    seconds = time.time() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"scenario": name, "seconds": seconds, "requests": fake.requests,
+        "bytes": fake.bytes, "peak_mb": peak / 1024.0 / 1024.0}
+
+def over_budget(result):
+    budget = BUDGETS.get(result["scenario"], {})
+    return ["%s %.2f > %s" % (k, result[k], v) for k, v in sorted(budget.items()) if result[k] > v]
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="bench.py")
+    parser.add_argument("scenarios", nargs="*")
+    parser.add_argument("--latency", type=float, default=20, help="per request, in ms")
+    parser.add_argument("--quick", action="store_true", help="skip the slow scenarios")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    names = args.scenarios or [n for n, s in SCENARIOS.items() if not (args.quick and s[2])]
+    for name in names:
+        if name not in SCENARIOS: parser.error("unknown scenario %s" % (name,))
+
+    fake = FakeGitHub(args.latency / 1000.0).start()
+    old_api_url, syg.API_URL = syg.API_URL, fake.url
+    results, failures = [], 0
+    try:
+        for name in names:
+            result = measure(fake, name)
+            problems = over_budget(result)
+            failures += len(problems)
+            results.append(result)
+            print("%-16s %8.3fs %6d requests %10d bytes %8.1f MB peak  %s" % (name,
+                result["seconds"], result["requests"], result["bytes"], result["peak_mb"],
+                "REGRESSION: " + ", ".join(problems) if problems else "ok"))
+    finally:
+        syg.API_URL = old_api_url
+        fake.stop()
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=1)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
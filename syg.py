@@ -1,13 +1,87 @@
 #!/usr/bin/python3
 
-import sys, requests, yaml, collections, deb822, base64
+import sys, os, collections, argparse, threading, json, time, heapq
+import itertools, contextlib, codecs, struct, mmap
+# requests, yaml, deb822 and the slower parts of the standard library are
+# imported where they are first used, so that syg starts quickly, and only
+# loads what a run needs (tests.TestStartup keeps it that way)
 
 #######################################################################
 # Handlers
 #######################################################################
 
-def HandlerBasic(snap, repo, filenames, tree_getter, file_getter):
-    # Guaranteed to be called first
+# Handlers are registered, in order, with the @handler decorator, which says
+# which top-level files or folders make a handler relevant to a repository;
+# only relevant handlers are called. reads lists the files a handler will
+# ask file_getter for, so that process_repo can fetch them all at once
+# before the handlers run.
+#
+# requires and provides list the top-level snap keys a handler reads and
+# writes. A handler waits for every earlier one it shares a key with in
+# either direction, and otherwise runs at the same time as them (see
+# run_handlers), so when two handlers write the same key the later one
+# still wins. A handler that declares neither is ordered against all
+# others; one that declares only one of them requires or provides nothing
+# else. Handlers may be coroutine functions.
+HANDLERS = []
+Triggers = collections.namedtuple("Triggers", "names suffixes dirs always")
+
+def handler(names=(), suffixes=(), dirs=(), always=False, reads=(), requires=None, provides=None):
+    def register(fn):
+        fn.triggers = Triggers(frozenset(names), frozenset(suffixes), frozenset(dirs), always)
+        fn.reads = tuple(reads)
+        declared = requires is not None or provides is not None
+        fn.requires = tuple(requires or ()) if declared else None
+        fn.provides = tuple(provides or ()) if declared else None
+        HANDLERS.append(fn)
+        return fn
+    return register
+
+def handler_conflicts(earlier, later):
+    if earlier.provides is None or later.provides is None: return True
+    return (not set(earlier.provides).isdisjoint(later.requires + later.provides)
+        or not set(earlier.requires).isdisjoint(later.provides))
+
+def snap_key_order(handlers):
+    order = collections.OrderedDict()
+    for h in handlers:
+        for key in h.provides or ():
+            order.setdefault(key, len(order))
+    return order
+
+def name_suffixes(name):
+    """The suffixes a handler can trigger on: "x.tar.gz" has ".tar.gz" and ".gz"."""
+    dot = name.find(".", 1)
+    while dot != -1:
+        yield name[dot:]
+        dot = name.find(".", dot + 1)
+
+class FilenameIndex(object):
+    """Hashed lookups over the top level of a repository (or of one folder
+       in it): its names, the suffixes of those names (".pro", ".tar.gz",
+       ".gz"), and its folders. Built once per repository, so that checking
+       a handler's triggers costs the same however many files there are."""
+    def __init__(self, index, folder=""):
+        self.names = set()
+        self.suffixes = set()
+        self.dirs = set()
+        prefix = folder + "/" if folder else ""
+        for name in index.listdir(folder):
+            self.names.add(name)
+            self.suffixes.update(name_suffixes(name))
+            if index.entries.get(prefix + name, {}).get("type", "tree") == "tree":
+                self.dirs.add(name)
+
+    def matches(self, triggers):
+        return (triggers.always
+            or not triggers.names.isdisjoint(self.names)
+            or not triggers.suffixes.isdisjoint(self.suffixes)
+            or not triggers.dirs.isdisjoint(self.dirs))
+
+@handler(always=True, requires=[], provides=["name", "summary", "description",
+    "grade", "confinement", "apps", "parts"]) # must be registered first
+def HandlerBasic(snap, repo, filenames, tree_getter, file_getter, client):
+    # Guaranteed to run before the handlers that need snap["name"] etc
     # Basic info, read from repo
     snap["name"] = repo.get("name", "(couldn't identify name)")
     snap["summary"] = repo.get("description", "(couldn't identify description)")
@@ -29,64 +103,93 @@ def HandlerBasic(snap, repo, filenames, tree_getter, file_getter):
             "source-type": "git"
         }
 
-    if "releases_url" in repo:
-        latest_release_url = repo["releases_url"].replace("{/id}", "/latest")
-        r = requests.get(latest_release_url)
+@handler(always=True, requires=[], provides=["version"])
+def HandlerVersion(snap, repo, filenames, tree_getter, file_getter, client):
+    # Independent of every other handler, so its request runs alongside them
+    if "latest_tag" in repo:
+        # local sources know their latest tag already
+        snap["version"] = repo["latest_tag"] or "0"
+    elif "releases_url" in repo:
+        r = client.get(latest_release_url(repo))
         out = r.json()
         snap["version"] = out.get("tag_name", "0")
     else:
         snap["version"] = "0"
 
-def HandlerPython(snap, repo, filenames, tree_getter, file_getter):
+@handler(names=["requirements.txt"],
+    requires=["name", "parts"], provides=["parts"])
+def HandlerPython(snap, repo, filenames, tree_getter, file_getter, client):
     if not snap.get("parts"): return
-    if "requirements.txt" not in filenames: return
     snap["parts"][snap["name"]] = {
         "plugin": "python",
         "python-version": "(choose python3 or python2)",
     }
 
-def HandlerCmake(snap, repo, filenames, tree_getter, file_getter):
+@handler(names=["CMakeLists.txt"],
+    requires=["name", "parts", "apps"], provides=["parts", "apps"])
+def HandlerCmake(snap, repo, filenames, tree_getter, file_getter, client):
     if not snap.get("parts"): return
-    if "CMakeLists.txt" not in filenames: return
     snap["parts"][snap["name"]] = {
         "plugin": "cmake",
         "qt-version": "(choose qt4 or qt5)"
     }
     snap["apps"][snap["name"]]["plugs"] = ["network", "network-bind", "unity7", "opengl"]
 
-def HandlerQmake(snap, repo, filenames, tree_getter, file_getter):
+@handler(suffixes=[".pro"],
+    requires=["name", "parts", "apps"], provides=["parts", "apps"])
+def HandlerQmake(snap, repo, filenames, tree_getter, file_getter, client):
     if not snap.get("parts"): return
-    if len([x for x in filenames if x.endswith(".pro")]) == 0: return
     snap["parts"][snap["name"]] = {
         "plugin": "qmake",
         "qt-version": "(choose qt4 or qt5)"
     }
     snap["apps"][snap["name"]]["plugs"] = ["network", "network-bind", "unity7", "opengl"]
 
-def HandlerMake(snap, repo, filenames, tree_getter, file_getter):
+@handler(names=["Makefile"],
+    requires=["name", "parts"], provides=["parts"])
+def HandlerMake(snap, repo, filenames, tree_getter, file_getter, client):
     if not snap.get("parts"): return
-    if "Makefile" not in filenames: return
     snap["parts"][snap["name"]] = {"plugin": "make"}
 
-def HandlerAutotools(snap, repo, filenames, tree_getter, file_getter):
+@handler(names=["configure.ac"],
+    requires=["name", "parts"], provides=["parts"])
+def HandlerAutotools(snap, repo, filenames, tree_getter, file_getter, client):
     if not snap.get("parts"): return
-    if "configure.ac" not in filenames: return
     snap["parts"][snap["name"]] = {"plugin": "autotools"}
 
-def HandlerDebian(snap, repo, filenames, tree_getter, file_getter):
+@handler(dirs=["debian"], reads=["debian/control"],
+    requires=["name", "parts"], provides=["parts"])
+def HandlerDebian(snap, repo, filenames, tree_getter, file_getter, client):
     if not snap.get("parts"): return
-    if "debian" not in filenames: return
     debian_filenames = tree_getter(["debian"])
     if "control" not in debian_filenames: return
     control = file_getter("debian/control")
+    if control is None: return
+    buildDeps = parsed_blob("build-depends", control, parse_build_depends)
+    snap["parts"][snap["name"]]["build-packages"] = resolve_build_depends(buildDeps, PACKAGE_INDEX)
+
+def parse_build_depends(control):
+    """The build dependencies, as a tuple of relation groups, each a tuple
+       of the alternative package names ("a | b")."""
+    import deb822
     deb = deb822.Sources(control)
     buildDepsCNF = deb.relations.get("build-depends", [])
     buildDepsIndepCNF = deb.relations.get("build-depends-indep", [])
-    buildDeps = []
-    for node in buildDepsCNF + buildDepsIndepCNF:
-        for dep in node:
-            buildDeps.append(dep["name"])
-    snap["parts"][snap["name"]]["build-packages"] = buildDeps
+    return tuple(tuple(dep["name"] for dep in node) for node in buildDepsCNF + buildDepsIndepCNF)
+
+def resolve_build_depends(groups, index=None):
+    """One package for each relation group: the first alternative that is in
+       index (a PackageIndex), or, with no index, the first alternative. A
+       group with nothing in the index becomes a placeholder to fix by hand."""
+    packages = []
+    for group in groups:
+        if index is None:
+            choice = group[0]
+        else:
+            choice = next((name for name in group if name in index),
+                "(no package for %s)" % (" | ".join(group),))
+        if choice not in packages: packages.append(choice)
+    return packages
 
 
 #######################################################################
@@ -95,65 +198,952 @@ def HandlerDebian(snap, repo, filenames, tree_getter, file_getter):
 
 class SygException(Exception): pass
 class SygSyntaxException(SygException): pass
+class SygRepoNotFoundException(SygException): pass
+class SygHTTPException(SygException): pass
 HEADERS = {'user-agent': 'popey/syg'}
+API_URL = "https://api.github.com"
+PREFETCH_WORKERS = 4
+PACKAGE_INDEX = None # a PackageIndex that build-packages are checked against
 
-def get_file_getter(apiurl, trees, owner, reponame):
-    def getter(filename):
-        """Fetch a specific file from the repo. Note that it is your responsibility
-           to be sure that it exists. Check with a tree-getter first."""
-        contents_url = "https://api.github.com/repos/%s/%s/contents/%s" % (owner, reponame, filename)
-        r = requests.get(contents_url)
+class DiskLRU(object):
+    """Files under directory/xx/, at most max_bytes of them in all: once past
+       that, the least recently written or used (by mtime) are removed."""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%s.tmp" % (path, threading.get_ident())
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        with self.lock:
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.entries())
+            else:
+                self.size += len(data) - old
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def remove(self, path):
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            if self.size is not None: self.size -= size
+
+    def entries(self):
+        for folder in os.listdir(self.directory):
+            folder = os.path.join(self.directory, folder)
+            if not os.path.isdir(folder): continue
+            for name in os.listdir(folder):
+                if name.endswith(".tmp"): continue
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def evict(self):
+        # called with self.lock held; trim to 90% so we don't evict on every store
+        target = self.max_bytes * 0.9
+        for path, size, mtime in sorted(self.entries(), key=lambda e: e[2]):
+            if self.size <= target: break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+class ResponseCache(DiskLRU):
+    """A disk cache of GET responses, keyed by URL, for conditional requests.
+       Each entry keeps the ETag/Last-Modified validators so that a later fetch
+       of the same URL can send If-None-Match; a 304 reply is served from disk
+       and does not count against GitHub's rate limit. Entries older than ttl
+       seconds are discarded, and the least recently used entries are evicted
+       once the cache grows past max_bytes."""
+    KEEP_HEADERS = ("content-type", "etag", "last-modified", "link")
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, ttl=30 * 24 * 3600):
+        DiskLRU.__init__(self, directory, max_bytes)
+        self.ttl = ttl
+
+    def path(self, url):
+        import hashlib
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, url):
+        path = self.path(url)
+        try:
+            with open(path, "rb") as fp:
+                meta = json.loads(fp.readline().decode("utf-8"))
+                body = fp.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url: return None
+        if time.time() - meta.get("stored", 0) > self.ttl:
+            self.remove(path)
+            return None
+        meta["body"] = body
+        return meta
+
+    def touch(self, url):
+        """Mark url as just used and just revalidated."""
+        path = self.path(url)
+        try:
+            with open(path, "rb") as fp:
+                meta = json.loads(fp.readline().decode("utf-8"))
+                body = fp.read()
+        except (OSError, ValueError):
+            return
+        meta["stored"] = time.time()
+        self.write(path, meta, body)
+
+    def store(self, url, response):
+        headers = dict((k, response.headers[k]) for k in self.KEEP_HEADERS if k in response.headers)
+        if "etag" not in headers and "last-modified" not in headers: return
+        meta = {"url": url, "stored": time.time(), "headers": headers}
+        self.write(self.path(url), meta, response.content)
+
+    def write(self, path, meta, body):
+        self.write_file(path, json.dumps(meta).encode("utf-8") + b"\n" + body)
+
+class Coalescer(object):
+    """Runs fn once for any number of concurrent callers asking for the same
+       key; the others wait for, and share, its result (or its exception)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def run(self, key, fn, *args):
+        import concurrent.futures
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = concurrent.futures.Future()
+        if not leader: return future.result()
+        try:
+            result = fn(*args)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+def git_blob_sha(content):
+    import hashlib
+    return hashlib.sha1(b"blob %d\0" % (len(content),) + content).hexdigest()
+
+class BlobCache(object):
+    """File contents keyed by their git blob SHA, so a file that is byte for
+       byte the same in many repositories (forks, siblings) is fetched once
+       per scan. The most recently used blobs are kept in memory, and, given
+       a directory, all of them (up to max_bytes) on disk as well. Concurrent
+       fetches of one blob are coalesced."""
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024, memory_bytes=16 * 1024 * 1024):
+        self.disk = DiskLRU(directory, max_bytes) if directory else None
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = memory_bytes
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.coalescer = Coalescer()
+
+    def path(self, sha):
+        return os.path.join(self.disk.directory, sha[:2], sha)
+
+    def get(self, sha):
+        with self.lock:
+            content = self.memory.get(sha)
+            if content is not None:
+                self.memory.move_to_end(sha)
+                return content
+        if not self.disk: return None
+        path = self.path(sha)
+        try:
+            with open(path, "rb") as fp:
+                content = fp.read()
+            os.utime(path)
+        except OSError:
+            return None
+        self.remember(sha, content)
+        return content
+
+    def put(self, sha, content):
+        if git_blob_sha(content) != sha: return
+        self.remember(sha, content)
+        if self.disk: self.disk.write_file(self.path(sha), content)
+
+    def remember(self, sha, content):
+        with self.lock:
+            if sha in self.memory: return
+            self.memory[sha] = content
+            self.memory_size += len(content)
+            while self.memory_size > self.memory_bytes and self.memory:
+                self.memory_size -= len(self.memory.popitem(last=False)[1])
+
+    def fetch(self, sha, fetcher):
+        """The blob's content, from the cache or else fetcher() (once, however
+           many threads ask at the same time)."""
+        content = self.get(sha)
+        if content is not None: return content
+        def fetch_and_put():
+            content = fetcher()
+            if content is not None: self.put(sha, content)
+            return content
+        return self.coalescer.run(sha, fetch_and_put)
+
+_parsed_blobs = collections.OrderedDict()
+_parsed_blobs_lock = threading.Lock()
+def parsed_blob(kind, content, parse):
+    """parse(content), memoized by the content's blob SHA (and kind, for
+       the different ways one file might be parsed)."""
+    key = (kind, git_blob_sha(content))
+    with _parsed_blobs_lock:
+        if key in _parsed_blobs:
+            _parsed_blobs.move_to_end(key)
+            return _parsed_blobs[key]
+    result = parse(content)
+    with _parsed_blobs_lock:
+        _parsed_blobs[key] = result
+        while len(_parsed_blobs) > 1024:
+            _parsed_blobs.popitem(last=False)
+    return result
+
+class MemoryCache(object):
+    """The same interface as ResponseCache, but kept in memory: for a long
+       running process (see serve) that wants warm conditional requests
+       without a cache directory. Holds at most max_bytes of bodies, evicting
+       the least recently used."""
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=30 * 24 * 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None: return None
+            if time.time() - entry["stored"] > self.ttl:
+                self.size -= len(self.entries.pop(url)["body"])
+                return None
+            self.entries.move_to_end(url)
+            return entry
+
+    def touch(self, url):
+        with self.lock:
+            if url in self.entries:
+                self.entries[url]["stored"] = time.time()
+                self.entries.move_to_end(url)
+
+    def store(self, url, response):
+        headers = dict((k, response.headers[k]) for k in ResponseCache.KEEP_HEADERS if k in response.headers)
+        if "etag" not in headers and "last-modified" not in headers: return
+        entry = {"url": url, "stored": time.time(), "headers": headers, "body": response.content}
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old: self.size -= len(old["body"])
+            self.entries[url] = entry
+            self.size += len(entry["body"])
+            while self.size > self.max_bytes and self.entries:
+                self.size -= len(self.entries.popitem(last=False)[1]["body"])
+
+def cached_response(url, entry):
+    import requests.models, requests.structures
+    r = requests.models.Response()
+    r.status_code = 200
+    r.url = url
+    r.headers = requests.structures.CaseInsensitiveDict(entry.get("headers", {}))
+    r._content = entry["body"]
+    r.encoding = "utf-8"
+    r.from_cache = True
+    return r
+
+class RateLimiter(object):
+    """Schedules every request a Client makes. It keeps GitHub's remaining
+       request budget from the X-RateLimit-* headers, and when that runs out
+       (or a 403/429 comes back with Retry-After) it holds all requests until
+       the reset time, after which the refused request is retried, rather than
+       failing. If rate is set, requests are also paced by a token bucket of
+       that many requests a second. Waiting requests go in priority order
+       (lowest first), so that in a batch the repositories started earliest,
+       which are already part done, get finished first."""
+    def __init__(self, rate=None, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused_until = 0
+        self.remaining = None
+        self.limit = None
+        self.reset = None
+        self.sent = 0
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def wait_time(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = self.paused_until - now
+        if self.rate and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def acquire(self, priority=0):
+        with self.cond:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                wait = self.wait_time(time.time())
+                if self.waiting[0] == ticket and wait <= 0: break
+                self.cond.wait(wait if self.waiting[0] == ticket else None)
+            heapq.heappop(self.waiting)
+            if self.rate: self.tokens -= 1
+            self.sent += 1
+            self.cond.notify_all()
+
+    def update(self, response):
+        """Note the budget a response reports. Returns True if the request
+           was refused for being over the limit and should be sent again."""
+        headers = response.headers
+        now = time.time()
+        with self.cond:
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+                self.limit = int(headers.get("X-RateLimit-Limit", 0)) or self.limit
+                self.reset = float(headers.get("X-RateLimit-Reset", 0)) or self.reset
+            pause_until = None
+            if "Retry-After" in headers and response.status_code in (403, 429):
+                pause_until = now + float(headers["Retry-After"])
+            elif self.remaining == 0 and self.reset:
+                pause_until = self.reset + 1
+            if pause_until and pause_until > self.paused_until:
+                self.paused_until = pause_until
+                self.cond.notify_all()
+        return bool(pause_until) and response.status_code in (403, 429)
+
+    def projected_seconds(self, requests_needed):
+        """How long, at least, the budget will make us wait to send this many
+           more requests (0 if there's budget enough, or we don't know)."""
+        with self.cond:
+            if self.remaining is None or requests_needed <= self.remaining: return 0
+            if not self.reset or not self.limit: return 0
+            windows = (requests_needed - self.remaining - 1) // self.limit
+            return max(0, self.reset - time.time()) + windows * 3600
+
+class Profile(object):
+    """Where the time goes: every HTTP request (method, URL, status, seconds,
+       bytes, whether it was answered from the cache) and every handler run
+       (name, seconds) while processing a repository."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.handlers = []
+
+    def record_request(self, method, url, status, seconds, size, from_cache):
+        with self.lock:
+            self.requests.append({"method": method, "url": url, "status": status,
+                "seconds": seconds, "bytes": size, "cached": from_cache})
+
+    def record_handler(self, name, seconds):
+        with self.lock:
+            self.handlers.append({"handler": name, "seconds": seconds})
+
+    @contextlib.contextmanager
+    def timing_handler(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record_handler(name, time.time() - started)
+
+    def trace(self):
+        with self.lock:
+            return {"requests": list(self.requests), "handlers": list(self.handlers),
+                "summary": summarise_profiles([self])}
+
+def summarise_profiles(profiles):
+    requests_ = [r for p in profiles for r in p.requests]
+    handlers = collections.OrderedDict()
+    for p in profiles:
+        for h in p.handlers:
+            total = handlers.setdefault(h["handler"], {"calls": 0, "seconds": 0})
+            total["calls"] += 1
+            total["seconds"] += h["seconds"]
+    return {
+        "requests": len(requests_),
+        "cached": len([r for r in requests_ if r["cached"]]),
+        "bytes": sum(r["bytes"] for r in requests_),
+        "request_seconds": sum(r["seconds"] for r in requests_),
+        "slowest": sorted(requests_, key=lambda r: -r["seconds"])[:5],
+        "handlers": handlers,
+    }
+
+def format_summary(summary):
+    lines = ["%d requests (%d from cache), %d bytes, %.3fs waiting on requests" % (
+        summary["requests"], summary["cached"], summary["bytes"], summary["request_seconds"])]
+    for r in summary["slowest"]:
+        lines.append("  %.3fs %s %s %s" % (r["seconds"], r["status"], r["method"], r["url"]))
+    for name, h in summary["handlers"].items():
+        lines.append("  %.3fs in %d calls to %s" % (h["seconds"], h["calls"], name))
+    return "\n".join(lines)
+
+# what a request is being made for: its priority in the RateLimiter, and the
+# Profile, if any, that should record it
+RequestContext = collections.namedtuple("RequestContext", "priority profile")
+NO_CONTEXT = RequestContext(0, None)
+
+class Client(object):
+    """A keep-alive HTTP client shared by everything that talks to GitHub.
+       Connections are pooled (so a repository costs one TLS handshake, not one
+       per request), every request carries HEADERS and the auth token (from
+       GITHUB_TOKEN if not given), and 5xx responses and dropped connections
+       are retried with exponential backoff. Given a ResponseCache, GETs become
+       conditional requests against it. All requests are scheduled by a
+       RateLimiter. File contents are shared through a BlobCache. Safe to
+       share between threads."""
+    RATE_LIMIT_RETRIES = 5
+
+    def __init__(self, token=None, pool_size=10, timeout=30, retries=3, backoff=0.5,
+            cache=None, limiter=None, blobs=None):
+        import requests, requests.adapters
+        self.timeout = timeout
+        self.cache = cache
+        self.blobs = blobs or BlobCache()
+        self.limiter = limiter or RateLimiter()
+        self.local = threading.local()
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        token = token or os.environ.get("GITHUB_TOKEN")
+        if token:
+            self.session.headers["Authorization"] = "token %s" % (token,)
+        retry = requests.adapters.Retry(total=retries, backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+            pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @contextlib.contextmanager
+    def using(self, priority=None, profile=None):
+        """Requests made by this thread inside the block get this priority
+           and are recorded in this Profile (by default, those of any
+           enclosing block)."""
+        previous = self.context()
+        self.local.context = RequestContext(
+            previous.priority if priority is None else priority,
+            previous.profile if profile is None else profile)
+        try:
+            yield
+        finally:
+            self.local.context = previous
+
+    def context(self):
+        return getattr(self.local, "context", NO_CONTEXT)
+
+    def send(self, method, url, context, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.RATE_LIMIT_RETRIES):
+            self.limiter.acquire(context.priority)
+            r = self.session.request(method, url, **kwargs)
+            if not self.limiter.update(r): break
+        r.from_cache = False
+        return r
+
+    def record(self, context, method, url, started, r, size=None):
+        if not context.profile: return
+        context.profile.record_request(method, url, r.status_code,
+            time.time() - started, len(r.content) if size is None else size, r.from_cache)
+
+    def record_when_closed(self, context, method, url, started, r):
+        """A streamed response's body is read after get returns, so it is
+           recorded when the caller closes it, with the time taken to read it
+           and the bytes that came over the wire."""
+        if not context.profile: return
+        close = r.close
+        def close_and_record():
+            r.close = close
+            self.record(context, method, url, started, r, r.raw.tell())
+            close()
+        r.close = close_and_record
+
+    def post(self, url, context=None, **kwargs):
+        context = context or self.context()
+        started = time.time()
+        r = self.send("POST", url, context, **kwargs)
+        self.record(context, "POST", url, started, r)
+        return r
+
+    def get(self, url, context=None, **kwargs):
+        context = context or self.context()
+        started = time.time()
+        cacheable = self.cache and not kwargs.get("stream") and not kwargs.get("params")
+        entry = self.cache.lookup(url) if cacheable else None
+        if entry:
+            headers = dict(kwargs.pop("headers", None) or {})
+            if "etag" in entry["headers"]:
+                headers["If-None-Match"] = entry["headers"]["etag"]
+            if "last-modified" in entry["headers"]:
+                headers["If-Modified-Since"] = entry["headers"]["last-modified"]
+            kwargs["headers"] = headers
+        r = self.send("GET", url, context, **kwargs)
+        if entry and r.status_code == 304:
+            self.cache.touch(url)
+            r = cached_response(url, entry)
+        elif cacheable and r.status_code == 200:
+            self.cache.store(url, r)
+        if kwargs.get("stream"):
+            self.record_when_closed(context, "GET", url, started, r)
+        else:
+            self.record(context, "GET", url, started, r)
+        return r
+
+_default_client = None
+_default_client_lock = threading.Lock()
+def get_default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = Client()
+        return _default_client
+
+def contents_url(owner, reponame, filename):
+    return "%s/repos/%s/%s/contents/%s" % (API_URL, owner, reponame, filename)
+
+def latest_release_url(repo):
+    return repo["releases_url"].replace("{/id}", "/latest")
+
+class Prefetcher(object):
+    """Stands in for a Client while one repository is processed. start(url)
+       begins fetching url in the background, and a later get(url) waits for
+       that response rather than making the request again. submit(fn, ...)
+       runs anything else in the background with the same request context."""
+    def __init__(self, client, pool):
+        self.client = client
+        self.pool = pool
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def start(self, url):
+        # the pool's threads don't share our request context, so carry it over
+        context = self.client.context()
+        with self.lock:
+            if url not in self.futures:
+                self.futures[url] = self.pool.submit(self.client.get, url, context)
+
+    def submit(self, fn, *args):
+        context = self.client.context()
+        def run():
+            with self.client.using(context.priority, context.profile):
+                return fn(*args)
+        return self.pool.submit(run)
+
+    def get(self, url, **kwargs):
+        with self.lock:
+            future = None if set(kwargs) - set(["context"]) else self.futures.get(url)
+        if future: return future.result()
+        return self.client.get(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+def blob_url(owner, reponame, sha):
+    return "%s/repos/%s/%s/git/blobs/%s" % (API_URL, owner, reponame, sha)
+
+def get_file_getter(apiurl, trees, owner, reponame, client=None):
+    client = client or get_default_client()
+    entries = getattr(trees, "entries", {})
+    def fetch(url):
+        import base64
+        r = client.get(url)
+        if r.status_code != 200:
+            raise SygHTTPException("HTTP %s fetching %s" % (r.status_code, url))
         out = r.json()
         file_content_b64 = out.get("content")
         if not file_content_b64:
             return None
         file_content = base64.b64decode(file_content_b64)
         return file_content
+    def getter(filename):
+        """Fetch a specific file from the repo. Note that it is your responsibility
+           to be sure that it exists. Check with a tree-getter first."""
+        # files are fetched by blob SHA where the tree gave us one, so that
+        # the same content is only fetched (and decoded) once per scan
+        sha = entries.get(filename, {}).get("sha")
+        if sha and entries[filename].get("type", "blob") == "blob":
+            return client.blobs.fetch(sha, lambda: fetch(blob_url(owner, reponame, sha)))
+        return fetch(contents_url(owner, reponame, filename))
     return getter
 
-def get_tree_getter(trees):
-    def getter(folders):
-        def next(current_tree):
+class TreeIndex(object):
+    """Every path in a repository, from one recursive tree listing: a map of
+       full path -> tree entry, and of directory -> names of its children
+       (the root directory is "")."""
+    def __init__(self):
+        self.entries = {}
+        self.children = {"": []}
+
+    def add(self, path, entry):
+        if path in self.entries: return
+        self.entries[path] = entry
+        parent, _, name = path.rpartition("/")
+        self.children.setdefault(parent, []).append(name)
+        if entry.get("type") == "tree":
+            self.children.setdefault(path, [])
+
+    def add_listing(self, prefix, listing):
+        for entry in listing.get("tree", []):
+            self.add(prefix + entry["path"], entry)
+
+    def listdir(self, folder):
+        return self.children.get(folder, [])
+
+    def __contains__(self, path):
+        return path in self.entries
+
+class BuildFileIndex(TreeIndex):
+    """A TreeIndex for monorepos, which keeps only what handlers look at:
+       the top level, the folders there that trigger a handler (debian/),
+       and, at any depth, the files that trigger a build handler, each as
+       just its type and SHA. So memory grows with the number of build
+       files, not with the size of the tree."""
+    def __init__(self, handlers=None):
+        super().__init__()
+        handlers = HANDLERS if handlers is None else handlers
+        # the handlers that make a part of their own from the files in a folder
+        self.build_handlers = [h for h in handlers if "parts" in (h.provides or ())
+            and (h.triggers.names or h.triggers.suffixes)]
+        self.names = set(n for h in self.build_handlers for n in h.triggers.names)
+        self.suffixes = set(s for h in self.build_handlers for s in h.triggers.suffixes)
+        self.dirs = set(d for h in handlers for d in h.triggers.dirs)
+
+    def wanted(self, path):
+        parent, _, name = path.rpartition("/")
+        return (not parent or parent in self.dirs or name in self.names
+            or not self.suffixes.isdisjoint(name_suffixes(name)))
+
+    def add(self, path, entry):
+        if self.wanted(path):
+            super().add(path, {"type": entry.get("type"), "sha": entry.get("sha")})
+
+    def build_roots(self):
+        """[(folder, build handlers)] for every folder ("" is the top level)
+           with files that a build handler triggers on, except a folder inside
+           one that the same handler already builds, such as a subdirectory
+           of a CMake project or of a recursive make."""
+        roots = []
+        built = collections.defaultdict(set)
+        # sorted, a folder comes before everything inside it
+        for folder in sorted(self.children):
+            parts = folder.split("/")
+            ancestors = [""] + ["/".join(parts[:n]) for n in range(1, len(parts))] if folder else []
+            found = FilenameIndex(self, folder)
+            handlers = [h for h in self.build_handlers if found.matches(h.triggers)
+                and built[h].isdisjoint(ancestors)]
+            for h in handlers:
+                built[h].add(folder)
+            if handlers: roots.append((folder, handlers))
+        return roots
+
+def recursive_url(url):
+    return url + ("&" if "?" in url else "?") + "recursive=1"
+
+def get_json(client, url, context=None):
+    r = client.get(url, context)
+    if r.status_code != 200:
+        raise SygHTTPException("HTTP %s fetching %s" % (r.status_code, url))
+    return r.json()
+
+class StreamedListing(object):
+    """A tree listing that is parsed as it is read: listing.get("tree")
+       yields its entries one at a time, decoded with raw_decode from the
+       chunks of the response, so a listing of half a million entries is
+       never in memory at once. The other keys ("truncated") can be got once
+       the entries have all been read."""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.rest = {}
+
+    def get(self, key, default=None):
+        if key == "tree": return self.entries()
+        return self.rest.get(key, default)
+
+    def entries(self):
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        chunks = iter(self.chunks)
+        def read():
+            chunk = next(chunks, None)
+            if chunk is None: raise ValueError("tree listing ends early")
+            return utf8.decode(chunk)
+        # the keys before the array ("sha", "url") can't contain "tree" in quotes
+        buf = ""
+        while True:
+            start = buf.find('"tree"')
+            bracket = buf.find("[", start) if start != -1 else -1
+            if bracket != -1: break
+            buf += read()
+        head = buf[:start].rstrip().rstrip(",")
+        pos = bracket + 1
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                buf, pos = read(), 0
+                continue
+            if buf[pos] == "]": break
             try:
-                this_folder = folders.pop(0)
-            except IndexError:
-                return current_tree
-            matches = [x["url"] for x in current_tree["tree"] 
-                if x["path"] == this_folder and x["type"] == "tree"]
-            if not matches: return None
-
-            r = requests.get(matches[0], headers=HEADERS)
-            return next(r.json())
-
-        this_tree = next(trees)
-        return [x["path"] for x in this_tree.get("tree", [])]
+                entry, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # an entry cut in two by the end of a chunk
+                buf, pos = buf[pos:] + read(), 0
+                continue
+            yield entry
+            pos = end
+        tail = (buf[pos + 1:] + "".join(utf8.decode(c) for c in chunks)
+            + utf8.decode(b"", final=True)).lstrip().lstrip(",")
+        self.rest = json.loads(head + ("" if head.endswith("{") or tail.startswith("}") else ",") + tail)
+
+def stream_listing(client, url, context=None):
+    r = client.get(url, context, stream=True)
+    if r.status_code != 200:
+        r.close()
+        raise SygHTTPException("HTTP %s fetching %s" % (r.status_code, url))
+    def chunks():
+        # closed (and so recorded) once the listing has been read
+        with r:
+            yield from r.iter_content(65536)
+    return StreamedListing(chunks())
+
+def fetch_tree(trees_url, client, workers=8, index=None, stream=False):
+    """Fetch a whole tree into a TreeIndex (or into index). One ?recursive=1
+       request usually does it; if GitHub truncates the listing, each subtree
+       is fetched (recursively again, in parallel) until nothing is
+       truncated. With stream, recursive listings are parsed as they arrive
+       (see StreamedListing) rather than all at once."""
+    import concurrent.futures
+    index = TreeIndex() if index is None else index
+    get_listing = stream_listing if stream else get_json
+    listing = get_listing(client, recursive_url(trees_url))
+    index.add_listing("", listing)
+    if not listing.get("truncated"): return index
+
+    context = client.context()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # (prefix, url) of trees we have only got a partial listing for
+        level = [("", trees_url)]
+        while level:
+            shallow = pool.map(lambda t: get_json(client, t[1], context), level)
+            subtrees = []
+            for (prefix, url), listing in zip(level, shallow):
+                index.add_listing(prefix, listing)
+                subtrees.extend((prefix + e["path"] + "/", e["url"])
+                    for e in listing.get("tree", []) if e.get("type") == "tree")
+            deep = pool.map(lambda t: get_listing(client, recursive_url(t[1]), context), subtrees)
+            level = []
+            for (prefix, url), listing in zip(subtrees, deep):
+                index.add_listing(prefix, listing)
+                if listing.get("truncated"): level.append((prefix, url))
+    return index
+
+def get_tree_getter(index):
+    def getter(folders):
+        """List the names in a folder of the repo, given as a list of path
+           components, or [] if there is no such folder."""
+        return list(index.listdir("/".join(folders)))
     return getter
 
-def serialise(snap):
-    # http://stackoverflow.com/a/8661021
-    # http://stackoverflow.com/questions/9951852/pyyaml-dumping-things-backwards#comment26471464_17310199
-    represent_dict_order = lambda self, data:  self.represent_mapping('tag:yaml.org,2002:map', data.items())
-    yaml.SafeDumper.add_representer(collections.OrderedDict, represent_dict_order)
-    return yaml.safe_dump(snap, default_flow_style=False)
-
-def process_repo(apiurl, repourl, owner, reponame):
-    r = requests.get(apiurl, headers=HEADERS)
-    repo = r.json()
-    trees_url = repo.get("trees_url")
-    if not trees_url:
-        print("Error: repository %s not found" % (repourl,))
-        sys.exit(2)
-    trees_url = trees_url.replace("{/sha}", "/%s" % repo.get("default_branch", "master"))
-    r = requests.get(trees_url, headers=HEADERS)
-    trees = r.json()
-    filenames = [x["path"] for x in trees.get("tree", [])]
+_snap_dumper = None
+def snap_dumper():
+    """The safe dumper, in C if PyYAML was built with libyaml, which writes
+       an OrderedDict's keys in order, without touching yaml.SafeDumper.
+       Made on first use, as importing yaml is slow."""
+    global _snap_dumper
+    if _snap_dumper is None:
+        import yaml
+        class SnapDumper(getattr(yaml, "CSafeDumper", yaml.SafeDumper)): pass
+        # http://stackoverflow.com/a/8661021
+        # http://stackoverflow.com/questions/9951852/pyyaml-dumping-things-backwards#comment26471464_17310199
+        SnapDumper.add_representer(collections.OrderedDict,
+            lambda self, data: self.represent_mapping('tag:yaml.org,2002:map', data.items()))
+        _snap_dumper = SnapDumper
+    return _snap_dumper
 
+def serialise(snap, fp=None):
+    """snap as YAML; returned as a string, or, given fp, written to it."""
+    import yaml
+    return yaml.dump(snap, fp, Dumper=snap_dumper(), default_flow_style=False)
+
+def relevant_handlers(index):
+    found = FilenameIndex(index)
+    return [h for h in HANDLERS if found.matches(h.triggers)]
+
+def run_handlers(handlers, repo, index, file_getter, client, profile=None):
+    """Run the handlers, each as soon as the earlier handlers it conflicts
+       with (see handler_conflicts) are done, so that independent handlers,
+       and the requests they make, overlap. The scheduling is done by an
+       asyncio event loop: coroutine handlers are awaited on it, all sharing
+       the one loop, and plain handlers run in a thread pool (only made if
+       there are any). The snap's keys are then put in the order the
+       handlers declare them, so the result doesn't depend on which handler
+       finished first."""
+    import asyncio, concurrent.futures
     snap = collections.OrderedDict()
-    file_getter = get_file_getter(apiurl, trees, owner, reponame)
-    tree_getter = get_tree_getter(trees)
-    for h in HANDLERS:
-        h(snap, repo, filenames, tree_getter, file_getter)
-    return snap
+    filenames = index.listdir("")
+    tree_getter = get_tree_getter(index)
+    if profile is None and client is not None:
+        profile = client.context().profile
+    context = client.context() if client is not None else NO_CONTEXT
+
+    def scope(h):
+        stack = contextlib.ExitStack()
+        if client is not None:
+            stack.enter_context(client.using(context.priority, context.profile))
+        if profile:
+            stack.enter_context(profile.timing_handler(h.__name__))
+        return stack
+
+    def call(h):
+        with scope(h):
+            h(snap, repo, filenames, tree_getter, file_getter, client)
+
+    async def pipeline(pool):
+        loop = asyncio.get_running_loop()
+        tasks = {}
+        async def run_after(h, dependencies):
+            if dependencies: await asyncio.gather(*dependencies)
+            if asyncio.iscoroutinefunction(h):
+                with scope(h):
+                    await h(snap, repo, filenames, tree_getter, file_getter, client)
+            else:
+                await loop.run_in_executor(pool, call, h)
+        for n, h in enumerate(handlers):
+            dependencies = [tasks[g] for g in handlers[:n] if handler_conflicts(g, h)]
+            tasks[h] = loop.create_task(run_after(h, dependencies))
+        await asyncio.gather(*tasks.values())
+
+    plain = [h for h in handlers if not asyncio.iscoroutinefunction(h)]
+    if len(handlers) == 1 and plain:
+        call(handlers[0])
+    elif len(plain) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool:
+            asyncio.run(pipeline(pool))
+    else:
+        # at most one plain handler, which the loop's own executor can run
+        asyncio.run(pipeline(None))
+
+    order = snap_key_order(handlers)
+    keys = sorted(snap, key=lambda k: order.get(k, len(order)))
+    return collections.OrderedDict((k, snap[k]) for k in keys)
+
+def fetch_repo(apiurl, repourl, client):
+    r = client.get(apiurl)
+    try:
+        repo = r.json()
+    except ValueError:
+        repo = {}
+    if r.status_code == 404 or (r.status_code == 200 and not repo.get("trees_url")):
+        raise SygRepoNotFoundException("repository %s not found" % (repourl,))
+    if r.status_code != 200:
+        raise SygHTTPException("HTTP %s fetching %s: %s" % (r.status_code, apiurl,
+            repo.get("message", "")))
+    return repo
+
+def process_repo(apiurl, repourl, owner, reponame, client=None):
+    import concurrent.futures
+    client = client or get_default_client()
+    repo = fetch_repo(apiurl, repourl, client)
+    trees_url = repo["trees_url"].replace("{/sha}", "/%s" % repo.get("default_branch", "master"))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool:
+        # the latest release only depends on the repo, so fetch it alongside
+        # the tree; then fetch every file the relevant handlers will read,
+        # all at once, so the handlers themselves don't wait on the network
+        fetch = Prefetcher(client, pool)
+        if "releases_url" in repo:
+            fetch.start(latest_release_url(repo))
+        index = fetch_tree(trees_url, client)
+        handlers = relevant_handlers(index)
+        file_getter = get_file_getter(apiurl, index, owner, reponame, fetch)
+        files = {}
+        for h in handlers:
+            for filename in h.reads:
+                if filename in index and filename not in files:
+                    files[filename] = fetch.submit(file_getter, filename)
+        def prefetched_file_getter(filename):
+            if filename in files: return files[filename].result()
+            return file_getter(filename)
+        return run_handlers(handlers, repo, index, prefetched_file_getter, fetch)
+
+def part_name(folder, taken):
+    """A part name for a folder ("tools/cli" -> "tools-cli") not in taken."""
+    name = "".join(c if c.isalnum() else "-" for c in folder.lower()).strip("-") or "part"
+    candidate, n = name, 1
+    while candidate in taken:
+        n += 1
+        candidate = "%s-%d" % (name, n)
+    return candidate
+
+def folder_part(folder, handlers, repo, index, file_getter, client, name):
+    """Run HandlerBasic and the given build handlers as if folder were the
+       top of a repository called name, and return the part they make, and
+       the plugs its app needs."""
+    sub = TreeIndex()
+    for child in index.listdir(folder):
+        sub.add(child, index.entries.get(folder + "/" + child, {}))
+    snap = run_handlers([HandlerBasic] + handlers, dict(repo, name=name), sub,
+        lambda filename: file_getter(folder + "/" + filename), client)
+    part = snap["parts"][name]
+    part.setdefault("source", repo.get("clone_url", "(unknown)"))
+    part["source-subdir"] = folder
+    return part, snap["apps"][name].get("plugs", [])
+
+def process_monorepo(apiurl, repourl, owner, reponame, client=None):
+    """Like process_repo, but every folder with build files of its own, at
+       any depth, gets a part of its own (with source-subdir), rather than
+       only the top level being looked at. The tree is streamed into a
+       BuildFileIndex, so this works on trees of any size."""
+    import concurrent.futures
+    client = client or get_default_client()
+    repo = fetch_repo(apiurl, repourl, client)
+    trees_url = repo["trees_url"].replace("{/sha}", "/%s" % repo.get("default_branch", "master"))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool:
+        fetch = Prefetcher(client, pool)
+        if "releases_url" in repo:
+            fetch.start(latest_release_url(repo))
+        index = fetch_tree(trees_url, client, index=BuildFileIndex(), stream=True)
+        file_getter = get_file_getter(apiurl, index, owner, reponame, fetch)
+        snap = run_handlers(relevant_handlers(index), repo, index, file_getter, fetch)
+        roots = [(folder, handlers) for folder, handlers in index.build_roots() if folder]
+        if not roots or not snap.get("parts"): return snap
+        parts, app = snap["parts"], snap["apps"][snap["name"]]
+        top = parts[snap["name"]]
+        if "plugin" not in top and "build-packages" not in top:
+            # nothing is built at the top level, only in folders
+            del parts[snap["name"]]
+        for folder, handlers in roots:
+            name = part_name(folder, set(parts) | set([snap["name"]]))
+            parts[name], plugs = folder_part(folder, handlers, repo, index, file_getter, fetch, name)
+            for plug in plugs:
+                if plug not in app.setdefault("plugs", []): app["plugs"].append(plug)
+        return snap
 
 def main(repourl):
     # Process the name
@@ -164,29 +1154,901 @@ def main(repourl):
     if len(parts) != 5 or parts[0] != "https:" or parts[1] != "" or parts[2] != "github.com":
         raise SygSyntaxException
     owner, reponame = parts[3], parts[4]
-    apiurl = "https://api.github.com/repos/%s/%s" % (owner, reponame)
+    apiurl = "%s/repos/%s/%s" % (API_URL, owner, reponame)
     return (apiurl, repourl, owner, reponame)
 
-HANDLERS = [
-    HandlerBasic, # note that HandlerBasic must be first, so others can rely on snap["name"] etc existing
-    HandlerPython,
-    HandlerCmake,
-    HandlerQmake,
-    HandlerMake,
-    HandlerAutotools,
-    HandlerDebian
-]
+#######################################################################
+# Local sources: checkouts, bare repositories and archives
+#######################################################################
 
-if __name__ == "__main__":
+def all_reads():
+    return set(filename for h in HANDLERS for filename in h.reads)
+
+def add_with_parents(index, path, kind, **extra):
+    parent = path.rpartition("/")[0]
+    if parent and parent not in index:
+        add_with_parents(index, parent, "tree")
+    entry = {"path": path, "type": kind}
+    entry.update(extra)
+    index.add(path, entry)
+
+def git(path, *args):
+    import subprocess
+    try:
+        p = subprocess.run(("git", "-C", path) + args, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return p.stdout
+
+def git_repo_info(path, name):
+    repo = {"name": name, "latest_tag": None}
+    origin = git(path, "config", "--get", "remote.origin.url")
+    if origin: repo["clone_url"] = origin.decode("utf-8").strip()
+    tag = git(path, "describe", "--tags", "--abbrev=0")
+    if tag: repo["latest_tag"] = tag.decode("utf-8").strip()
+    return repo
+
+def open_directory(path):
+    """A working tree (or any folder) on disk. Files are read as asked for.
+       In a git checkout, only the files git tracks count, so that build
+       output and other untracked or ignored files (a Makefile generated by
+       CMake, node_modules/) don't look like part of the repository."""
+    path = os.path.abspath(path)
+    index = TreeIndex()
+    tracked = git(path, "ls-files", "-z")
+    for filename in (tracked or b"").split(b"\0"):
+        if filename: add_with_parents(index, filename.decode("utf-8"), "blob")
+    for folder, dirs, files in ([] if tracked else os.walk(path)):
+        dirs[:] = sorted(d for d in dirs if d != ".git")
+        rel = os.path.relpath(folder, path)
+        prefix = "" if rel == "." else rel.replace(os.sep, "/") + "/"
+        for d in dirs: index.add(prefix + d, {"path": prefix + d, "type": "tree"})
+        for f in sorted(files): index.add(prefix + f, {"path": prefix + f, "type": "blob"})
+    def file_getter(filename):
+        try:
+            with open(os.path.join(path, *filename.split("/")), "rb") as fp:
+                return fp.read()
+        except OSError:
+            return None
+    return git_repo_info(path, os.path.basename(path)), index, file_getter
+
+def open_bare_repo(path):
+    """A bare git repository, read at HEAD. Every file a handler might read
+       is pulled out with a single git cat-file --batch."""
+    import subprocess
+    path = os.path.abspath(path)
+    index = TreeIndex()
+    listing = git(path, "ls-tree", "-r", "-t", "-z", "HEAD") or b""
+    for line in listing.split(b"\0"):
+        if not line: continue
+        info, _, filename = line.partition(b"\t")
+        mode, kind, sha = info.decode("utf-8").split()
+        filename = filename.decode("utf-8")
+        index.add(filename, {"path": filename, "type": kind, "sha": sha})
+
+    wanted = [f for f in sorted(all_reads()) if f in index]
+    files = {}
+    if wanted:
+        try:
+            p = subprocess.run(("git", "-C", path, "cat-file", "--batch"),
+                input="".join("HEAD:%s\n" % f for f in wanted).encode("utf-8"),
+                stdout=subprocess.PIPE, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise SygException("%s: could not read files from git: %s" % (path, e))
+        out = p.stdout
+        for filename in wanted:
+            header, _, out = out.partition(b"\n")
+            if header.endswith(b" missing"): continue
+            size = int(header.split()[2])
+            files[filename], out = out[:size], out[size + 1:]
+    name = os.path.basename(path)
+    if name.endswith(".git"): name = name[:-4]
+    return git_repo_info(path, name), index, files.get
+
+def read_tarball(fileobj, wanted):
+    """Index a tar archive (compressed or not) in one streaming pass, without
+       writing anything to disk, keeping the contents of the wanted files.
+       A single top-level folder, as in GitHub tarballs, is stripped."""
+    import tarfile
+    members = []
+    contents = {}
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            name = member.name
+            while name.startswith("./"): name = name[2:]
+            name = name.rstrip("/")
+            if name in ("", "."): continue
+            members.append((name, member.isdir()))
+            # wanted, either as it is or once a top folder is stripped
+            if member.isfile() and (name in wanted or name.partition("/")[2] in wanted):
+                contents[name] = tar.extractfile(member).read()
+    # the top folder is only known once every member has been seen
+    tops = set(name.split("/", 1)[0] for name, isdir in members)
+    prefix = ""
+    if len(tops) == 1 and all(isdir or "/" in name for name, isdir in members):
+        prefix = tops.pop() + "/"
+    index = TreeIndex()
+    for name, isdir in members:
+        path = name[len(prefix):]
+        if path: add_with_parents(index, path, "tree" if isdir else "blob")
+    files = dict((name[len(prefix):], content) for name, content in contents.items()
+        if name[len(prefix):] in wanted)
+    return index, files
+
+def open_archive(path):
+    """A tarball or zipball on disk. Tarballs are read in a single streaming
+       pass; zip files are indexed from their directory and read lazily.
+       Anything that isn't one, or is damaged, is a SygException."""
+    import tarfile, zipfile
+    name = os.path.basename(path)
+    for ext in (".tar.gz", ".tar.bz2", ".tar.xz", ".tgz", ".tar", ".zip"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    repo = {"name": name, "latest_tag": None}
+    if zipfile.is_zipfile(path):
+        try:
+            zf = zipfile.ZipFile(path)
+        except zipfile.BadZipFile as e:
+            raise SygException("%s: bad zip file: %s" % (path, e))
+        names = zf.namelist()
+        tops = set(n.split("/", 1)[0] for n in names)
+        prefix = tops.pop() + "/" if len(tops) == 1 and all("/" in n for n in names) else ""
+        index = TreeIndex()
+        for n in names:
+            p = n[len(prefix):].rstrip("/")
+            if p: add_with_parents(index, p, "tree" if n.endswith("/") else "blob")
+        def file_getter(filename):
+            try:
+                return zf.read(prefix + filename)
+            except KeyError:
+                return None
+            except zipfile.BadZipFile as e:
+                raise SygException("%s: bad zip file: %s" % (path, e))
+        return repo, index, file_getter
+    try:
+        with open(path, "rb") as fp:
+            index, files = read_tarball(fp, all_reads())
+    except (tarfile.TarError, EOFError) as e:
+        raise SygException("%s: not a tarball or zip file: %s" % (path, e))
+    return repo, index, files.get
+
+def process_local(path, profile=None):
+    """Generate a snap from a checkout, a bare repository or an archive file."""
+    if os.path.isfile(path):
+        repo, index, file_getter = open_archive(path)
+    elif not os.path.isdir(path):
+        raise SygRepoNotFoundException("%s not found" % (path,))
+    elif (git(path, "rev-parse", "--is-bare-repository") or b"").strip() == b"true":
+        repo, index, file_getter = open_bare_repo(path)
+    else:
+        repo, index, file_getter = open_directory(path)
+    return run_handlers(relevant_handlers(index), repo, index, file_getter, None, profile)
+
+def tarball_url(apiurl, repo):
+    archive_url = repo.get("archive_url")
+    if not archive_url: return apiurl + "/tarball"
+    return archive_url.replace("{archive_format}", "tarball").replace("{/ref}", "")
+
+def process_archive(apiurl, repourl, owner, reponame, client=None):
+    """Like process_repo, but fetch the whole repository as one tarball
+       (streamed, not saved) rather than a tree listing plus a request per
+       file. Better when many files are needed or the tree is huge."""
+    import concurrent.futures
+    client = client or get_default_client()
+    repo = fetch_repo(apiurl, repourl, client)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        fetch = Prefetcher(client, pool)
+        if "releases_url" in repo:
+            fetch.start(latest_release_url(repo))
+        r = client.get(tarball_url(apiurl, repo), stream=True)
+        if r.status_code != 200:
+            r.close()
+            raise SygRepoNotFoundException("no archive for repository %s" % (repourl,))
+        r.raw.decode_content = True
+        with r:
+            index, files = read_tarball(r.raw, all_reads())
+        return run_handlers(relevant_handlers(index), repo, index, files.get, fetch)
+
+#######################################################################
+# GraphQL: the whole repository in one query
+#######################################################################
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_QUERY = """query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) {
+    name
+    description
+    url
+    defaultBranchRef {
+      name
+      target { ... on Commit { tree { entries { name type
+        object { ... on Tree { entries { name type } } } } } } }
+    }
+    latestRelease { tagName }
+%s  }
+}"""
+GRAPHQL_BLOB = """    f%d: object(expression: %s) { ... on Blob { text } }
+"""
+
+def graphql_query(filenames):
+    """The query for a repository's metadata, latest release, its top two
+       levels of tree, and the contents of each of filenames (as f0, f1...;
+       a file that isn't there comes back as null)."""
+    blobs = "".join(GRAPHQL_BLOB % (n, json.dumps("HEAD:" + f)) for n, f in enumerate(filenames))
+    return GRAPHQL_QUERY % (blobs,)
+
+def process_graphql(apiurl, repourl, owner, reponame, client=None, endpoint=None):
+    """Like process_repo, but with a single GraphQL query fetching the repo,
+       its latest release, the tree entries handlers look at and every file
+       a handler may read. Needs an auth token (GitHub's GraphQL API does not
+       allow anonymous queries)."""
+    client = client or get_default_client()
+    filenames = sorted(all_reads())
+    r = client.post(endpoint or GRAPHQL_URL, json={
+        "query": graphql_query(filenames),
+        "variables": {"owner": owner, "name": reponame}
+    })
     try:
-        if len(sys.argv) != 2: raise SygSyntaxException
-        apiurl, repourl, owner, reponame = main(sys.argv[1])
-        snap = process_repo(apiurl, repourl, owner, reponame)
-        snapcraft_yaml = serialise(snap)
-        fp = open("snapcraft.yaml", "w")
-        fp.write(snapcraft_yaml)
-        fp.close()
+        out = r.json()
+    except ValueError:
+        raise SygException("GraphQL query for %s failed (HTTP %s)" % (repourl, r.status_code))
+    data = (out.get("data") or {}).get("repository")
+    if not data:
+        # parse and validation errors come back as 200 too, without a type
+        errors = out.get("errors") or []
+        if r.status_code == 200 and (not errors or errors[0].get("type") == "NOT_FOUND"):
+            raise SygRepoNotFoundException("repository %s not found" % (repourl,))
+        raise SygException("GraphQL query for %s failed: %s" % (repourl,
+            (errors[0].get("message") if errors else None) or out.get("message") or r.status_code))
+
+    branch = data.get("defaultBranchRef") or {}
+    repo = {
+        "name": data.get("name"),
+        "description": data.get("description"),
+        "clone_url": data["url"] + ".git" if data.get("url") else None,
+        "default_branch": branch.get("name"),
+        "latest_tag": (data.get("latestRelease") or {}).get("tagName"),
+    }
+    if repo["clone_url"] is None: del repo["clone_url"]
+    if repo["description"] is None: del repo["description"]
+
+    index = TreeIndex()
+    tree = ((branch.get("target") or {}).get("tree") or {}).get("entries") or []
+    for entry in tree:
+        index.add(entry["name"], {"path": entry["name"], "type": entry["type"]})
+        for sub in (entry.get("object") or {}).get("entries") or []:
+            path = entry["name"] + "/" + sub["name"]
+            index.add(path, {"path": path, "type": sub["type"]})
+
+    files = {}
+    for n, filename in enumerate(filenames):
+        blob = data.get("f%d" % (n,))
+        if blob and blob.get("text") is not None:
+            files[filename] = blob["text"].encode("utf-8")
+    return run_handlers(relevant_handlers(index), repo, index, files.get, client)
+
+BACKENDS = {
+    "api": process_repo,
+    "archive": process_archive,
+    "graphql": process_graphql,
+    "monorepo": process_monorepo,
+}
+
+#######################################################################
+# Incremental regeneration
+#######################################################################
+
+GRAPHQL_VERSION_QUERY = """query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) {
+    defaultBranchRef { target { ... on Commit { tree { oid } } } }
+    latestRelease { tagName }
+  }
+}"""
+
+class StateStore(object):
+    """Remembers, for each repository (and backend), the default branch's
+       tree SHA and the latest release tag that its snap was generated from,
+       the package index its build-packages were checked against, and the
+       snap itself, as one JSON file per repository."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, owner, reponame, backend):
+        return os.path.join(self.directory, owner.lower(), "%s.%s.json" % (reponame.lower(), backend))
+
+    def load(self, owner, reponame, backend):
+        """The saved state, with the snap as run_handlers makes it: only its
+           own keys are kept in order; the dicts in it are plain, so they
+           are written sorted, just as in a fresh run."""
+        try:
+            with open(self.path(owner, reponame, backend)) as fp:
+                saved = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if isinstance(saved.get("snap"), dict):
+            saved["snap"] = collections.OrderedDict(saved["snap"])
+        return saved
+
+    def save(self, owner, reponame, backend, version, snap, packages_index=None):
+        path = self.path(owner, reponame, backend)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%s.tmp" % (path, threading.get_ident())
+        with open(tmp, "w") as fp:
+            json.dump({"tree_sha": version[0], "release": version[1],
+                "packages_index": packages_index, "snap": snap}, fp)
+        os.replace(tmp, path)
+
+def current_version(apiurl, owner, reponame, client, backend="api"):
+    """(tree SHA of the default branch, latest release tag or None) for a
+       repository, as cheaply as possible: one GraphQL query, or two REST
+       requests in parallel (which the response cache turns into 304s)."""
+    import concurrent.futures
+    if backend == "graphql":
+        r = client.post(GRAPHQL_URL, json={"query": GRAPHQL_VERSION_QUERY,
+            "variables": {"owner": owner, "name": reponame}})
+        data = ((r.json() if r.status_code == 200 else {}).get("data") or {}).get("repository") or {}
+        target = (data.get("defaultBranchRef") or {}).get("target") or {}
+        return ((target.get("tree") or {}).get("oid"),
+            (data.get("latestRelease") or {}).get("tagName"))
+    context = client.context()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        commit = pool.submit(client.get, apiurl + "/commits/HEAD", context)
+        release = pool.submit(client.get, apiurl + "/releases/latest", context)
+        commit, release = commit.result(), release.result()
+    tree_sha = None
+    if commit.status_code == 200:
+        tree_sha = commit.json().get("commit", {}).get("tree", {}).get("sha")
+    tag = release.json().get("tag_name") if release.status_code == 200 else None
+    return tree_sha, tag
+
+def process_incremental(apiurl, repourl, owner, reponame, client, backend, state):
+    """Return the snap saved in state if neither the tree nor the latest
+       release has moved since it was generated, and the package index is
+       the same one; otherwise regenerate it with the backend and save it."""
+    version = current_version(apiurl, owner, reponame, client, backend)
+    packages_index = PACKAGE_INDEX.identity if PACKAGE_INDEX is not None else None
+    saved = state.load(owner, reponame, backend)
+    if (saved and version[0] and [saved["tree_sha"], saved["release"]] == list(version)
+            and saved.get("packages_index") == packages_index):
+        return saved["snap"]
+    snap = BACKENDS[backend](apiurl, repourl, owner, reponame, client)
+    if version[0]:
+        state.save(owner, reponame, backend, version, snap, packages_index)
+    return snap
+
+#######################################################################
+# Debian package index
+#######################################################################
+
+class PackageIndex(object):
+    """The names of the packages in an archive, real ones and the virtual
+       ones they provide, sorted and memory-mapped from a file written by
+       PackageIndex.build, so that looking one up is a binary search over a
+       few pages of it, without reading the whole archive into memory.
+
+       The file is MAGIC, the number of names n, n + 1 offsets (all
+       little-endian unsigned 32-bit), and then the UTF-8 names, one after
+       another; name i runs from offset i to offset i + 1."""
+    MAGIC = b"SYGPKGS1"
+    HEADER = struct.Struct("<8sI")
+    OFFSET = struct.Struct("<I")
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(fp.fileno())
+        # which index this is, for StateStore: rebuilding it changes this
+        self.identity = "%s:%d:%d" % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        magic, self.count = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC: raise SygException("%s is not a package index" % (path,))
+        self.names = self.HEADER.size + self.OFFSET.size * (self.count + 1)
+
+    @classmethod
+    def build(cls, packages_files, path):
+        """Write an index of the packages in Packages files (which may be
+           compressed with gzip or xz) to path."""
+        import deb822, gzip, lzma
+        names = set()
+        for packages in packages_files:
+            opener = {".gz": gzip.open, ".xz": lzma.open}.get(os.path.splitext(packages)[1], open)
+            with opener(packages, "rb") as fp:
+                for para in deb822.Packages.iter_paragraphs(fp, fields=["Package", "Provides"],
+                        use_apt_pkg=False):
+                    if "Package" in para: names.add(para["Package"])
+                    names.update(dep["name"] for group in para.relations["provides"] for dep in group)
+        names = [n.encode("utf-8") for n in sorted(names)]
+        offsets = list(itertools.accumulate([0] + [len(n) for n in names]))
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as fp:
+            fp.write(cls.HEADER.pack(cls.MAGIC, len(names)))
+            fp.write(struct.pack("<%dI" % (len(offsets),), *offsets))
+            fp.write(b"".join(names))
+        os.replace(tmp, path)
+        return len(names)
+
+    def name(self, n):
+        start, end = struct.unpack_from("<II", self.map, self.HEADER.size + self.OFFSET.size * n)
+        return self.map[self.names + start:self.names + end]
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        key = name.encode("utf-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = self.name(mid)
+            if probe == key: return True
+            if probe < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def close(self):
+        self.map.close()
+
+
+#######################################################################
+# Batch mode
+#######################################################################
+
+def read_repo_list(fp):
+    """One repository URL per line; blank lines and #comments are ignored."""
+    for line in fp:
+        line = line.split("#", 1)[0].strip()
+        if line: yield line
+
+def owner_repos(owner, client=None):
+    """Yield the HTML URL of every repository of a GitHub organisation or
+       user, a page of 100 at a time, following the Link headers, so that a
+       scan can start on the first page before the last has been fetched."""
+    client = client or get_default_client()
+    url = "%s/orgs/%s/repos?per_page=100&type=all" % (API_URL, owner)
+    r = client.get(url)
+    if r.status_code == 404:
+        # not an organisation; try it as a user
+        url = "%s/users/%s/repos?per_page=100&type=owner" % (API_URL, owner)
+        r = client.get(url)
+        if r.status_code == 404: raise SygRepoNotFoundException(owner)
+    while True:
+        if r.status_code != 200:
+            raise SygHTTPException("HTTP %s fetching %s" % (r.status_code, url))
+        for repo in r.json():
+            yield repo["html_url"]
+        url = r.links.get("next", {}).get("url")
+        if not url: return
+        r = client.get(url)
+
+class Checkpoint(object):
+    """An append-only file of the repositories a scan has finished, one JSON
+       object per line, so that an interrupted scan can be resumed. Only
+       repositories that succeeded are skipped on resume; failures are tried
+       again. resumed is whether an earlier scan recorded anything, so that
+       its output is added to rather than replaced."""
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.resumed = False
+        line = "\n"
+        try:
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # a line cut short when the scan was killed
+                    self.resumed = True
+                    if entry.get("ok"):
+                        self.done.add(entry["repo"])
+        except OSError:
+            pass
+        self.fp = open(path, "a")
+        if not line.endswith("\n"):
+            self.fp.write("\n") # so the next entry is not joined to a cut-short one
+
+    def __contains__(self, repourl):
+        return repourl in self.done
+
+    def record(self, repourl, ok):
+        self.fp.write(json.dumps({"repo": repourl, "ok": ok}) + "\n")
+        self.fp.flush()
+        if ok: self.done.add(repourl)
+
+    def close(self):
+        self.fp.close()
+
+def process_one(repourl, client=None, backend="api", priority=None, profile=None, state=None):
+    apiurl, repourl, owner, reponame = main(repourl)
+    client = client or get_default_client()
+    with client.using(priority, profile):
+        if state:
+            snap = process_incremental(apiurl, repourl, owner, reponame, client, backend, state)
+        else:
+            snap = BACKENDS[backend](apiurl, repourl, owner, reponame, client)
+    return owner, reponame, snap
+
+def write_snap(outdir, owner, reponame, snap):
+    folder = os.path.join(outdir, owner, reponame)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, "snapcraft.yaml")
+    with open(path, "w") as fp:
+        serialise(snap, fp)
+    return path
+
+class DirectoryWriter(object):
+    """Writes each snap as outdir/owner/reponame/snapcraft.yaml."""
+    def __init__(self, outdir):
+        self.outdir = outdir
+
+    def write(self, repourl, owner, reponame, snap):
+        return write_snap(self.outdir, owner, reponame, snap)
+
+    def error(self, repourl, message):
+        pass
+
+    def close(self):
+        pass
+
+def open_output(path, mode="w"):
+    """path, opened for writing, or stdout if path is -."""
+    return sys.stdout if path == "-" else open(path, mode)
+
+class StreamWriter(object):
+    """Writes every result to one file (or, if path is -, to stdout), each
+       flushed as soon as it is written: in "yaml" format, as a YAML document
+       per snap, headed by a comment naming the repository, with errors as
+       comments; in "jsonl" format, as a line of JSON per result,
+       {"repo": ..., "snap": ...} or {"repo": ..., "error": ...}. Appended
+       to, a repository can have a result from each run that tried it; the
+       last one is the one that counts."""
+    FORMATS = ("yaml", "jsonl")
+
+    def __init__(self, path, format="yaml", append=False):
+        self.path = path
+        self.format = format
+        self.fp = open_output(path, "a" if append else "w")
+
+    def write(self, repourl, owner, reponame, snap):
+        if self.format == "jsonl":
+            self.fp.write(json.dumps(collections.OrderedDict([("repo", repourl), ("snap", snap)])) + "\n")
+        else:
+            self.fp.write("--- # %s\n" % (repourl,))
+            serialise(snap, self.fp)
+        self.fp.flush()
+        return self.path
+
+    def error(self, repourl, message):
+        if self.format == "jsonl":
+            self.fp.write(json.dumps(collections.OrderedDict([("repo", repourl), ("error", message)])) + "\n")
+        else:
+            self.fp.write("# error: %s: %s\n" % (repourl, message.replace("\n", " ")))
+        self.fp.flush()
+
+    def close(self):
+        if self.fp is not sys.stdout: self.fp.close()
+
+def projected_completion(done, total, elapsed, limiter):
+    """Seconds until a batch finishes: the rate so far, or, if it would run
+       past the rate limit budget, the wait that imposes."""
+    if not done or total is None: return None
+    left = total - done
+    by_throughput = elapsed / done * left
+    by_budget = limiter.projected_seconds(int(limiter.sent / done * left))
+    return max(by_throughput, by_budget)
+
+def process_batch(repourls, outdir, workers=8, client=None, backend="api",
+        total=None, progress=None, profiles=None, state=None, writer=None,
+        checkpoint=None):
+    """Run process_one over every URL in repourls on a pool of worker threads,
+       writing each snapcraft.yaml under outdir as soon as it is ready (or
+       handing it to writer, a DirectoryWriter or StreamWriter).
+       A failing repository is recorded in the summary and does not stop the
+       others. Returns a list of (repourl, ok, path-or-error) tuples, which is
+       also written to outdir/summary.txt, if there is an outdir. Repositories are prioritised in
+       the order they were started. If given, progress(done, total, eta) is
+       called as each one finishes (total and eta may be None). If profiles
+       is a dict, it gets a Profile for each repository URL. With a
+       StateStore, unchanged repositories are not regenerated. With a
+       Checkpoint, repositories it has already finished are skipped and
+       each one finished now is recorded in it, and, when it is resumed,
+       summary.txt is added to, so a repository that failed before and was
+       tried again has two lines in it, the later one being its result."""
+    import concurrent.futures
+    if outdir: os.makedirs(outdir, exist_ok=True)
+    client = client or Client(pool_size=workers * PREFETCH_WORKERS)
+    writer = writer or DirectoryWriter(outdir)
+    results = []
+    summary_mode = "a" if checkpoint and checkpoint.resumed else "w"
+    started = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        def collect(done):
+            for future in done:
+                repourl = pending.pop(future)
+                try:
+                    owner, reponame, snap = future.result()
+                    results.append((repourl, True, writer.write(repourl, owner, reponame, snap)))
+                except SygSyntaxException:
+                    results.append((repourl, False, "not a GitHub HTTPS repository URL"))
+                except Exception as e:
+                    results.append((repourl, False, str(e) or e.__class__.__name__))
+                if not results[-1][1]:
+                    writer.error(repourl, results[-1][2])
+                if checkpoint:
+                    checkpoint.record(repourl, results[-1][1])
+                if progress:
+                    progress(len(results), total, projected_completion(len(results), total,
+                        time.time() - started, client.limiter))
+        for priority, repourl in enumerate(repourls):
+            if checkpoint and repourl in checkpoint: continue
+            # keep a bounded number of repositories in flight, so that a huge
+            # list on stdin is not read (and queued) all at once
+            if len(pending) >= workers * 2:
+                done, _ = concurrent.futures.wait(pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            profile = None
+            if profiles is not None:
+                profile = profiles[repourl] = Profile()
+            pending[pool.submit(process_one, repourl, client, backend, priority, profile, state)] = repourl
+        collect(list(pending))
+    if outdir:
+        with open(os.path.join(outdir, "summary.txt"), summary_mode) as fp:
+            for repourl, ok, detail in results:
+                fp.write("%s\t%s\t%s\n" % ("ok" if ok else "error", repourl, detail))
+    return results
+
+
+#######################################################################
+# Service mode
+#######################################################################
+
+class ServiceHandler(object):
+    """GET /generate?repo=https://github.com/owner/name[&backend=...]
+       returns that repository's snapcraft.yaml, using the server's default
+       backend if none is given. Mixed in with
+       http.server.BaseHTTPRequestHandler by make_server."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        import urllib.parse
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != "/generate":
+            return self.reply(404, "Not found: try /generate?repo=<github URL>\n")
+        backend = query.get("backend", [self.server.backend])[0]
+        if backend not in BACKENDS:
+            return self.reply(400, "Unknown backend %s\n" % (backend,))
+        try:
+            apiurl, repourl, owner, reponame = main(query.get("repo", [""])[0])
+        except SygSyntaxException:
+            return self.reply(400, "repo must be a GitHub HTTPS repository URL\n")
+        try:
+            snapcraft_yaml = self.server.coalescer.run((owner.lower(), reponame.lower(), backend),
+                self.generate, apiurl, repourl, owner, reponame, backend)
+        except SygRepoNotFoundException as e:
+            return self.reply(404, "Error: %s\n" % (e,))
+        except Exception as e:
+            return self.reply(502, "Error: %s\n" % (str(e) or e.__class__.__name__,))
+        self.reply(200, snapcraft_yaml, "text/yaml; charset=utf-8")
+
+    def generate(self, apiurl, repourl, owner, reponame, backend):
+        snap = BACKENDS[backend](apiurl, repourl, owner, reponame, self.server.client)
+        return serialise(snap)
+
+    def reply(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print("%s %s" % (self.address_string(), format % args), file=sys.stderr)
+
+def make_server(host, port, client=None, backend="api"):
+    """A threaded HTTP server generating snaps on request, with backend
+       unless a request asks for another. Every request
+       shares one Client, so the connection pool and the response cache
+       (in memory, unless the Client already has one) stay warm, and
+       concurrent requests for the same repository are coalesced."""
+    import http.server
+    handler = type("ServiceHandler", (ServiceHandler, http.server.BaseHTTPRequestHandler), {})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.client = client or Client(pool_size=32, cache=MemoryCache())
+    if server.client.cache is None: server.client.cache = MemoryCache()
+    server.coalescer = Coalescer()
+    server.backend = backend
+    return server
+
+#######################################################################
+# Command line
+#######################################################################
+
+USAGE = ("Usage: syg <github HTTPS repository URL>\n"
+    "       syg --batch <file of URLs, or - for stdin> [--output DIR] [--workers N]\n"
+    "       syg --org <GitHub organisation or user> [--output DIR] [--workers N]\n"
+    "       syg --local <checkout, bare repository, or .tar.gz/.zip archive>\n"
+    "       syg --serve [HOST:]PORT (GET /generate?repo=<github URL> returns snapcraft.yaml)\n"
+    "       syg --make-packages-index <Packages file> [--make-packages-index ...]\n"
+    "           --packages-index FILE (index the package names in an archive's Packages files)\n"
+    "--output is a folder to write snapcraft.yaml (or, with --batch or --org, a\n"
+    "folder of them) to, or a file, or - for stdout; with --format, --batch and\n"
+    "--org write every result to that one file, so --output must name it.\n"
+    "options: --cache DIR (reuse responses with conditional requests)\n"
+    "         --blob-cache DIR (keep file contents by blob SHA, shared across repositories)\n"
+    "         --rate N (send at most N requests a second)\n"
+    "         --profile FILE (write a JSON trace of requests and handlers)\n"
+    "         --state DIR (skip repositories whose tree and release haven't changed)\n"
+    "         --format yaml|jsonl (YAML documents, or a line of JSON per repository)\n"
+    "         --packages-index FILE (check build-packages against this package index,\n"
+    "             choosing the first alternative it has)\n"
+    "         --checkpoint FILE (with --batch or --org, record finished repositories\n"
+    "             in FILE, and skip them when run again, adding to the output and\n"
+    "             summary; the last result for a repository is the one that counts)\n"
+    "         --backend api|archive|graphql|monorepo (per-file API calls, one tarball\n"
+    "             download, one GraphQL query, which needs GITHUB_TOKEN, or per-file\n"
+    "             API calls with a part for every folder with its own build files)\n"
+    "(for example, https://github.com/snapcore/snapcraft)")
+
+class ArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise SygSyntaxException(message)
+
+def parse_args(argv):
+    parser = ArgumentParser(prog="syg", add_help=False)
+    parser.add_argument("repourl", nargs="?")
+    parser.add_argument("--batch")
+    parser.add_argument("--org")
+    parser.add_argument("--local")
+    parser.add_argument("--serve")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="api")
+    parser.add_argument("--output")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--cache")
+    parser.add_argument("--blob-cache")
+    parser.add_argument("--rate", type=float)
+    parser.add_argument("--profile")
+    parser.add_argument("--state")
+    parser.add_argument("--format", choices=StreamWriter.FORMATS)
+    parser.add_argument("--checkpoint")
+    parser.add_argument("--packages-index")
+    parser.add_argument("--make-packages-index", action="append")
+    args = parser.parse_args(argv)
+    if len([a for a in (args.repourl, args.batch, args.org, args.local, args.serve,
+            args.make_packages_index) if a]) != 1:
+        raise SygSyntaxException
+    if args.make_packages_index and not args.packages_index:
+        raise SygSyntaxException
+    if args.checkpoint and not (args.batch or args.org):
+        raise SygSyntaxException
+    if args.format and (args.batch or args.org) and not args.output:
+        raise SygSyntaxException # a stream of results needs a file, or - for stdout
+    args.output = args.output or "."
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        if not port.isdigit(): raise SygSyntaxException
+        args.serve = (host or "127.0.0.1", int(port))
+    if args.workers < 1: raise SygSyntaxException
+    if args.rate is not None and args.rate <= 0: raise SygSyntaxException
+    return args
+
+def write_profile(path, profiles):
+    """Write the trace of each repository, and a summary of them all, as JSON
+       to path, and the summary for people to stderr."""
+    summary = summarise_profiles(list(profiles.values()))
+    with open(path, "w") as fp:
+        json.dump({
+            "repos": collections.OrderedDict((k, p.trace()) for k, p in profiles.items()),
+            "summary": summary
+        }, fp, indent=1)
+    print(format_summary(summary), file=sys.stderr)
+
+def format_duration(seconds):
+    """Seconds as, say, "1d 06:00:00"; time.strftime would wrap at a day."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return "%s%02d:%02d:%02d" % ("%dd " % (days,) if days else "", hours, minutes, seconds)
+
+def report_progress(every=10):
+    last = [0]
+    def progress(done, total, eta):
+        if time.time() - last[0] < every and done != total: return
+        last[0] = time.time()
+        when = "" if eta is None else ", done in about %s" % (format_duration(eta),)
+        print("%d/%s repositories%s" % (done, total or "?", when), file=sys.stderr)
+    return progress
+
+def cli(argv):
+    global PACKAGE_INDEX
+    try:
+        args = parse_args(argv)
+        if args.make_packages_index:
+            count = PackageIndex.build(args.make_packages_index, args.packages_index)
+            print("%d package names in %s" % (count, args.packages_index), file=sys.stderr)
+            return 0
+        if args.packages_index:
+            PACKAGE_INDEX = PackageIndex(args.packages_index)
+        cache = ResponseCache(args.cache) if args.cache else None
+        state = StateStore(args.state) if args.state else None
+        blobs = BlobCache(args.blob_cache) if args.blob_cache else None
+        client = None
+        if not args.local:
+            # only made for the modes that go to GitHub, as it imports requests
+            client = Client(pool_size=args.workers * PREFETCH_WORKERS, cache=cache,
+                limiter=RateLimiter(rate=args.rate), blobs=blobs)
+        if args.serve:
+            server = make_server(args.serve[0], args.serve[1], client, args.backend)
+            print("Serving on http://%s:%d/generate?repo=..." % server.server_address[:2], file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            return 0
+        if args.batch or args.org:
+            checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+            if args.org:
+                # enumerated page by page as the scan goes, so the total is unknown
+                repourls, total = owner_repos(args.org, client), None
+            else:
+                fp = sys.stdin if args.batch == "-" else open(args.batch)
+                with fp:
+                    repourls = list(read_repo_list(fp))
+                total = len([r for r in repourls if not (checkpoint and r in checkpoint)])
+            outdir, writer = args.output, None
+            if args.format or args.output == "-":
+                # one stream of results rather than a folder of files
+                outdir, writer = None, StreamWriter(args.output, args.format or "yaml",
+                    append=bool(checkpoint and checkpoint.resumed))
+            profiles = collections.OrderedDict() if args.profile else None
+            try:
+                results = process_batch(repourls, outdir, args.workers, client,
+                    args.backend, total, report_progress(), profiles, state, writer, checkpoint)
+            finally:
+                if writer: writer.close()
+                if checkpoint: checkpoint.close()
+            if args.profile:
+                write_profile(args.profile, profiles)
+            failed = [r for r in results if not r[1]]
+            for repourl, ok, detail in failed:
+                print("Error: %s: %s" % (repourl, detail), file=sys.stderr)
+            print("%d repositories, %d failed" % (len(results), len(failed)), file=sys.stderr)
+            return 3 if failed else 0
+        profile = Profile() if args.profile else None
+        if args.local:
+            snap = process_local(args.local, profile)
+        else:
+            snap = process_one(args.repourl, client, args.backend, profile=profile, state=state)[2]
+        if args.profile:
+            write_profile(args.profile, {args.local or args.repourl: profile})
+        path = args.output
+        if path != "-" and os.path.isdir(path):
+            path = os.path.join(path, "snapcraft.jsonl" if args.format == "jsonl" else "snapcraft.yaml")
+        if args.format == "jsonl":
+            writer = StreamWriter(path, "jsonl")
+            writer.write(args.local or args.repourl, None, None, snap)
+            writer.close()
+        else:
+            fp = open_output(path)
+            serialise(snap, fp)
+            if fp is not sys.stdout: fp.close()
     except SygSyntaxException:
-        print("Usage: syg <github HTTPS repository URL>\n"
-            "(for example, https://github.com/snapcore/snapcraft)", file=sys.stderr)
-        sys.exit(1)
+        print(USAGE, file=sys.stderr)
+        return 1
+    except SygException as e:
+        print("Error: %s" % (e,), file=sys.stderr)
+        return 2
+    except OSError as e:
+        print("Error: %s" % (e,), file=sys.stderr)
+        return 2
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli(sys.argv[1:]))
@@ -1,8 +1,25 @@
 import unittest
 import syg
+import bench
 import requests_mock
 import json
 import base64
+import io
+import os
+import tempfile
+import subprocess
+import tarfile
+import zipfile
+import gzip
+import threading
+import asyncio
+import time
+import contextlib
+import collections
+import yaml
+import requests
+import concurrent.futures
+import sys
 
 class TestCommandLine(unittest.TestCase):
     def test_no_url(self):
@@ -248,16 +265,12 @@ class TestDebianHandler(unittest.TestCase):
             "default_branch": "strange",
             "clone_url": self.CLONE_URL
         }))
-        m.get("internal://trees/strange", text=json.dumps({
+        m.get("internal://trees/strange?recursive=1", text=json.dumps({
             "tree": [
                 {"path": "readme.txt", "type": "blob"}, 
-                {"path": "debian", "url": "internal://trees/strange/debian", "type": "tree"}
-            ]
-        }))
-        m.get("internal://trees/strange/debian", text=json.dumps({
-            "tree": [
-                {"path": "subreadme.txt", "type": "blob"}, 
-                {"path": "control", "url": "internal://trees/strange/debian/control", "type": "blob"}
+                {"path": "debian", "url": "internal://trees/strange/debian", "type": "tree"},
+                {"path": "debian/subreadme.txt", "type": "blob"}, 
+                {"path": "debian/control", "url": "internal://trees/strange/debian/control", "type": "blob"}
             ]
         }))
 
@@ -272,46 +285,676 @@ class TestDebianHandler(unittest.TestCase):
         return syg.process_repo("https://api.github.com/repos/madeup1/madeup2",
             "https://github.com/madeup1/madeup2", "madeup1", "madeup2")
 
-    def test_called_four(self, m):
+    def test_called_three(self, m):
         output = self.basic_request(m)
-        self.assertEqual(m.call_count, 4)
+        self.assertEqual(m.call_count, 3)
 
     def test_build_packages(self, m):
         output = self.basic_request(m)
         self.assertEqual(output["parts"][self.NAME]["build-packages"], ["pies", "lard"])
 
+class TestPackageIndex(unittest.TestCase):
+    PACKAGES = (b"Package: pies\nVersion: 2.4\nDescription: pies\n  with several lines\n\n"
+        b"Package: libfoo2-dev\nProvides: libfoo-api (= 2), gravy\n\n"
+        b"Package: lard\nVersion: 1\n")
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        packages = os.path.join(folder, "Packages.gz")
+        with gzip.open(packages, "wb") as fp:
+            fp.write(self.PACKAGES)
+        self.path = os.path.join(folder, "index")
+        self.assertEqual(syg.PackageIndex.build([packages], self.path), 5)
+        self.index = syg.PackageIndex(self.path)
+    def tearDown(self):
+        self.index.close()
+
+    def test_lookup(self):
+        for name in ("gravy", "lard", "libfoo-api", "libfoo2-dev", "pies"):
+            self.assertIn(name, self.index)
+        for name in ("", "a", "libfoo", "pie", "piesz", "zzz"):
+            self.assertNotIn(name, self.index)
+        self.assertEqual(len(self.index), 5)
+    def test_resolve(self):
+        groups = (("libfoo-dev", "libfoo2-dev"), ("pies",), ("custard", "trifle"), ("pies",))
+        self.assertEqual(syg.resolve_build_depends(groups, self.index),
+            ["libfoo2-dev", "pies", "(no package for custard | trifle)"])
+        self.assertEqual(syg.resolve_build_depends(groups), ["libfoo-dev", "pies", "custard"])
+    def test_handler(self):
+        folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(folder, "debian"))
+        with open(os.path.join(folder, "debian", "control"), "wb") as fp:
+            fp.write(b"Source: x\nBuild-Depends: libfoo-dev | libfoo2-dev, lard\n")
+        old_index, syg.PACKAGE_INDEX = syg.PACKAGE_INDEX, self.index
+        try:
+            output = syg.process_local(folder)
+        finally:
+            syg.PACKAGE_INDEX = old_index
+        self.assertEqual(output["parts"][os.path.basename(folder)]["build-packages"],
+            ["libfoo2-dev", "lard"])
+    def test_not_an_index(self):
+        with open(self.path, "wb") as fp:
+            fp.write(b"\0" * 64)
+        self.assertRaises(syg.SygException, syg.PackageIndex, self.path)
+    def test_cli(self):
+        self.assertEqual(syg.cli(["--make-packages-index", "/dev/null", "--packages-index", self.path]), 0)
+        self.assertEqual(len(syg.PackageIndex(self.path)), 0)
+        self.assertRaises(syg.SygSyntaxException, syg.parse_args, ["--make-packages-index", "Packages"])
+
+class TestDebianHandlerDirect(unittest.TestCase):
+    def test_no_control_content(self):
+        snap = {"name": "x", "parts": {"x": {"plugin": "make"}}}
+        syg.HandlerDebian(snap, {}, ["debian"], lambda folders: ["control"],
+            lambda filename: None, None)
+        self.assertEqual(snap["parts"]["x"], {"plugin": "make"})
+
+class TestHandlerRegistry(unittest.TestCase):
+    def filename_index(self, entries):
+        index = syg.TreeIndex()
+        for path, kind in entries:
+            index.add(path, {"path": path, "type": kind})
+        return syg.FilenameIndex(index)
+
+    def test_order(self):
+        self.assertEqual(syg.HANDLERS[0], syg.HandlerBasic)
+        self.assertEqual(syg.HANDLERS[-1], syg.HandlerDebian)
+    def test_suffixes(self):
+        found = self.filename_index([("whatever.pro", "blob"), ("a.tar.gz", "blob")])
+        self.assertEqual(found.suffixes, set([".pro", ".tar.gz", ".gz"]))
+    def test_dirs(self):
+        found = self.filename_index([("debian", "tree"), ("Makefile", "blob")])
+        self.assertTrue(found.matches(syg.HandlerDebian.triggers))
+        self.assertTrue(found.matches(syg.HandlerMake.triggers))
+        self.assertFalse(found.matches(syg.HandlerQmake.triggers))
+    def test_file_is_not_dir(self):
+        found = self.filename_index([("debian", "blob")])
+        self.assertFalse(found.matches(syg.HandlerDebian.triggers))
+    def test_nested_ignored(self):
+        found = self.filename_index([("src", "tree"), ("src/Makefile", "blob")])
+        self.assertFalse(found.matches(syg.HandlerMake.triggers))
+    def test_always(self):
+        found = self.filename_index([])
+        self.assertTrue(found.matches(syg.HandlerBasic.triggers))
+
+@requests_mock.mock()
+class TestPrefetch(unittest.TestCase):
+    CONTROL = "https://api.github.com/repos/madeup1/madeup2/contents/debian/control"
+    def basic_request(self, m, tree):
+        m.get("https://api.github.com/repos/madeup1/madeup2", text=json.dumps({
+            "name": "dunno",
+            "trees_url": "internal://trees{/sha}",
+            "releases_url": "internal://releases{/id}"
+        }))
+        m.get("internal://trees/master", text=json.dumps({"tree": tree}))
+        m.get("internal://releases/latest", text=json.dumps({"tag_name": "1.0"}))
+        m.get(self.CONTROL, text=json.dumps({
+            "content": base64.b64encode(b"Source: x\nBuild-Depends: lard\n").decode("utf-8")
+        }))
+        return syg.process_repo("https://api.github.com/repos/madeup1/madeup2",
+            "https://github.com/madeup1/madeup2", "madeup1", "madeup2", syg.Client())
+
+    def test_declared_file_fetched_once(self, m):
+        output = self.basic_request(m, [
+            {"path": "debian", "type": "tree"}, {"path": "debian/control", "type": "blob"}])
+        self.assertEqual(output["parts"]["dunno"]["build-packages"], ["lard"])
+        self.assertEqual([r.url for r in m.request_history].count(self.CONTROL), 1)
+        self.assertEqual(m.call_count, 4)
+    def test_missing_file_not_fetched(self, m):
+        self.basic_request(m, [{"path": "debian", "type": "tree"}])
+        self.assertNotIn(self.CONTROL, [r.url for r in m.request_history])
+    def test_unmatched_handler_not_prefetched(self, m):
+        self.basic_request(m, [{"path": "debian/control", "type": "blob"}])
+        self.assertNotIn(self.CONTROL, [r.url for r in m.request_history])
+    def test_prefetcher(self, m):
+        m.get("internal://thing", text="ok")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            fetch = syg.Prefetcher(syg.Client(), pool)
+            fetch.start("internal://thing")
+            fetch.start("internal://thing")
+            self.assertEqual(fetch.get("internal://thing").text, "ok")
+        self.assertEqual(m.call_count, 1)
+
+class LocalFixture(object):
+    CONTROL = b"Source: x\nBuild-Depends: pies (>=2.3), lard\n"
+    def make_tree(self):
+        folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(folder, "debian"))
+        with open(os.path.join(folder, "Makefile"), "w") as fp: fp.write("all:\n")
+        with open(os.path.join(folder, "debian", "control"), "wb") as fp: fp.write(self.CONTROL)
+        return folder
+
+    def make_tarball(self, prefix="myproj-1234abc/", dirs=True):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode="w:gz") as tar:
+            for name, content in [(prefix, None), (prefix + "Makefile", b"all:\n"),
+                    (prefix + "debian/", None), (prefix + "debian/control", self.CONTROL)]:
+                if content is None and not dirs: continue
+                info = tarfile.TarInfo(name.rstrip("/"))
+                if content is None:
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                else:
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+        return data.getvalue()
+
+    def check(self, output, name):
+        self.assertEqual(output["name"], name)
+        self.assertEqual(output["parts"][name]["plugin"], "make")
+        self.assertEqual(output["parts"][name]["build-packages"], ["pies", "lard"])
+
+class TestLocalSources(unittest.TestCase, LocalFixture):
+    def git(self, *args):
+        subprocess.run(("git", "-c", "user.name=t", "-c", "user.email=t@example.com") + args,
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_directory(self):
+        folder = self.make_tree()
+        self.check(syg.process_local(folder), os.path.basename(folder))
+    def test_directory_version(self):
+        folder = self.make_tree()
+        self.assertEqual(syg.process_local(folder)["version"], "0")
+    def test_output_stdout(self):
+        folder = self.make_tree()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(syg.cli(["--local", folder, "--output", "-"]), 0)
+        self.check(yaml.safe_load(out.getvalue()), os.path.basename(folder))
+    def test_output_folder_jsonl(self):
+        folder = self.make_tree()
+        outdir = tempfile.mkdtemp()
+        self.assertEqual(syg.cli(["--local", folder, "--output", outdir, "--format", "jsonl"]), 0)
+        self.assertEqual(os.listdir(outdir), ["snapcraft.jsonl"])
+    def test_output_path(self):
+        folder = self.make_tree()
+        path = os.path.join(tempfile.mkdtemp(), "snap.json")
+        self.assertEqual(syg.cli(["--local", folder, "--output", path, "--format", "jsonl"]), 0)
+        with open(path) as fp:
+            self.check(json.load(fp)["snap"], os.path.basename(folder))
+
+    def test_checkout_tracked_only(self):
+        folder = self.make_tree()
+        with open(os.path.join(folder, "CMakeLists.txt"), "w") as fp: fp.write("project(x)\n")
+        self.git("-C", folder, "init", "-q")
+        self.git("-C", folder, "add", "CMakeLists.txt", "debian")
+        os.makedirs(os.path.join(folder, "build"))
+        output = syg.process_local(folder)
+        name = os.path.basename(folder)
+        self.assertEqual(output["parts"][name]["plugin"], "cmake")
+        self.assertEqual(output["parts"][name]["build-packages"], ["pies", "lard"])
+        self.assertNotIn("build", syg.open_directory(folder)[1])
+    def test_bare_repo(self):
+        folder = self.make_tree()
+        self.git("-C", folder, "init", "-q")
+        self.git("-C", folder, "add", ".")
+        self.git("-C", folder, "commit", "-q", "-m", "first")
+        self.git("-C", folder, "tag", "v1.2")
+        bare = os.path.join(tempfile.mkdtemp(), "thing.git")
+        self.git("clone", "-q", "--bare", folder, bare)
+        output = syg.process_local(bare)
+        self.check(output, "thing")
+        self.assertEqual(output["version"], "v1.2")
+        self.assertEqual(syg.open_bare_repo(bare)[0]["clone_url"], folder)
+
+    def test_tarball(self):
+        path = os.path.join(tempfile.mkdtemp(), "myproj.tar.gz")
+        with open(path, "wb") as fp: fp.write(self.make_tarball())
+        self.check(syg.process_local(path), "myproj")
+    def test_tarball_streamed(self):
+        index, files = syg.read_tarball(io.BytesIO(self.make_tarball()), set(["debian/control"]))
+        self.assertEqual(index.listdir(""), ["Makefile", "debian"])
+        self.assertEqual(list(files.keys()), ["debian/control"])
+    def test_tarball_of_dot(self):
+        # tar -C proj -czf proj.tgz .
+        index, files = syg.read_tarball(io.BytesIO(self.make_tarball("./")), set(["debian/control"]))
+        self.assertEqual(index.listdir(""), ["Makefile", "debian"])
+        self.assertEqual(files, {"debian/control": self.CONTROL})
+    def test_tarball_without_folders(self):
+        path = os.path.join(tempfile.mkdtemp(), "myproj.tar.gz")
+        with open(path, "wb") as fp: fp.write(self.make_tarball("proj/", dirs=False))
+        self.check(syg.process_local(path), "myproj")
+    def test_tarball_without_top_folder(self):
+        index, files = syg.read_tarball(io.BytesIO(self.make_tarball("", dirs=False)),
+            set(["debian/control"]))
+        self.assertEqual(index.listdir(""), ["Makefile", "debian"])
+        self.assertEqual(files, {"debian/control": self.CONTROL})
+    def test_zip(self):
+        path = os.path.join(tempfile.mkdtemp(), "myproj.zip")
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("myproj-main/Makefile", "all:\n")
+            zf.writestr("myproj-main/debian/control", self.CONTROL)
+        self.check(syg.process_local(path), "myproj")
+    def test_missing(self):
+        self.assertRaises(syg.SygRepoNotFoundException, syg.process_local, "/nonexistent/nope")
+    def test_not_an_archive(self):
+        path = os.path.join(tempfile.mkdtemp(), "notes.txt")
+        with open(path, "w") as fp: fp.write("not a tarball\n")
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            self.assertEqual(syg.cli(["--local", path, "--output", "-"]), 2)
+        self.assertIn("Error: %s: not a tarball or zip file" % (path,), err.getvalue())
+    def test_damaged_zip(self):
+        path = os.path.join(tempfile.mkdtemp(), "myproj.zip")
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("myproj-main/Makefile", "all:\n")
+            zf.writestr("myproj-main/debian/control", self.CONTROL)
+        with open(path, "rb") as fp: data = fp.read()
+        with open(path, "wb") as fp: fp.write(data.replace(b"lard", b"LARD"))
+        self.assertRaises(syg.SygException, syg.process_local, path)
+
+@requests_mock.mock()
+class TestArchiveBackend(unittest.TestCase, LocalFixture):
+    def basic_request(self, m, client=None):
+        m.get("https://api.github.com/repos/madeup1/madeup2", text=json.dumps({
+            "name": "dunno",
+            "trees_url": "internal://trees{/sha}",
+            "archive_url": "internal://archive/{archive_format}{/ref}",
+            "releases_url": "internal://releases{/id}"
+        }))
+        m.get("internal://releases/latest", text=json.dumps({"tag_name": "1.0"}))
+        m.get("internal://archive/tarball", content=self.make_tarball())
+        return syg.process_archive("https://api.github.com/repos/madeup1/madeup2",
+            "https://github.com/madeup1/madeup2", "madeup1", "madeup2", client or syg.Client())
+
+    def test_archive(self, m):
+        output = self.basic_request(m)
+        self.check(output, "dunno")
+        self.assertEqual(output["version"], "1.0")
+    def test_called_three(self, m):
+        self.basic_request(m)
+        self.assertEqual(m.call_count, 3)
+    def test_profile(self, m):
+        profile = syg.Profile()
+        client = syg.Client()
+        with client.using(profile=profile):
+            self.basic_request(m, client)
+        tarball = [r for r in profile.requests if r["url"] == "internal://archive/tarball"]
+        self.assertEqual([r["bytes"] for r in tarball], [len(self.make_tarball())])
+
+@requests_mock.mock()
+class TestGraphQLBackend(unittest.TestCase):
+    ENDPOINT = "internal://graphql"
+    NAME = "dunno"
+    def respond(self, request, context):
+        # a stand-in for GitHub's GraphQL endpoint, answering just this query
+        body = request.json()
+        self.queries.append(body)
+        if body["variables"]["name"] != self.NAME:
+            return json.dumps({"data": {"repository": None},
+                "errors": [{"type": "NOT_FOUND", "message": "Could not resolve"}]})
+        repository = {
+            "name": self.NAME,
+            "description": "some app or other",
+            "url": "https://github.com/madeup1/" + self.NAME,
+            "defaultBranchRef": {"name": "strange", "target": {"tree": {"entries": [
+                {"name": "Makefile", "type": "blob", "object": {}},
+                {"name": "debian", "type": "tree", "object": {"entries": [
+                    {"name": "control", "type": "blob"}]}}
+            ]}}},
+            "latestRelease": {"tagName": "1.0.2"}
+        }
+        for n in range(10):
+            if '"HEAD:debian/control"' in body["query"].split("f%d:" % n)[-1].split("\n")[0]:
+                repository["f%d" % n] = {"text": "Source: x\nBuild-Depends: pies, lard\n"}
+        return json.dumps({"data": {"repository": repository}})
+
+    def basic_request(self, m, name="dunno"):
+        self.queries = []
+        m.post(self.ENDPOINT, text=self.respond)
+        return syg.process_graphql("https://api.github.com/repos/madeup1/" + name,
+            "https://github.com/madeup1/" + name, "madeup1", name, syg.Client(),
+            endpoint=self.ENDPOINT)
+
+    def test_one_query(self, m):
+        self.basic_request(m)
+        self.assertEqual(m.call_count, 1)
+    def test_metadata(self, m):
+        output = self.basic_request(m)
+        self.assertEqual(output["name"], self.NAME)
+        self.assertEqual(output["summary"], "some app or other")
+        self.assertEqual(output["version"], "1.0.2")
+    def test_handlers(self, m):
+        output = self.basic_request(m)
+        self.assertEqual(output["parts"][self.NAME]["plugin"], "make")
+        self.assertEqual(output["parts"][self.NAME]["build-packages"], ["pies", "lard"])
+    def test_variables(self, m):
+        self.basic_request(m)
+        self.assertEqual(self.queries[0]["variables"], {"owner": "madeup1", "name": self.NAME})
+    def test_not_found(self, m):
+        self.assertRaises(syg.SygRepoNotFoundException, self.basic_request, m, "missing")
+    def test_query_error(self, m):
+        m.post(self.ENDPOINT, text=json.dumps({"errors": [{"message": "Parse error on \"}\" (RCURLY)",
+            "locations": [{"line": 3, "column": 1}]}]}))
+        with self.assertRaises(syg.SygException) as raised:
+            syg.process_graphql("https://api.github.com/repos/madeup1/dunno",
+                "https://github.com/madeup1/dunno", "madeup1", "dunno", syg.Client(),
+                endpoint=self.ENDPOINT)
+        self.assertNotIsInstance(raised.exception, syg.SygRepoNotFoundException)
+        self.assertIn("Parse error", str(raised.exception))
+
+@requests_mock.mock()
+class TestBlobCache(unittest.TestCase):
+    CONTROL = b"Source: x\nBuild-Depends: pies, lard\n"
+    def mock_repo(self, m, owner):
+        sha = syg.git_blob_sha(self.CONTROL)
+        m.get("https://api.github.com/repos/%s/dunno" % (owner,), text=json.dumps({
+            "name": "dunno",
+            "trees_url": "internal://%s/trees{/sha}" % (owner,)
+        }))
+        m.get("internal://%s/trees/master" % (owner,), text=json.dumps({"tree": [
+            {"path": "debian", "type": "tree"},
+            {"path": "debian/control", "type": "blob", "sha": sha}
+        ]}))
+        m.get("https://api.github.com/repos/%s/dunno/git/blobs/%s" % (owner, sha), text=json.dumps({
+            "content": base64.b64encode(self.CONTROL).decode("utf-8"), "encoding": "base64"
+        }))
+
+    def blob_requests(self, m):
+        return [r.url for r in m.request_history if "/git/blobs/" in r.url]
+
+    def test_forks_share_blob(self, m):
+        self.mock_repo(m, "upstream")
+        self.mock_repo(m, "fork")
+        client = syg.Client()
+        for owner in ("upstream", "fork"):
+            output = syg.process_repo("https://api.github.com/repos/%s/dunno" % (owner,),
+                "https://github.com/%s/dunno" % (owner,), owner, "dunno", client)
+            self.assertEqual(output["parts"]["dunno"]["build-packages"], ["pies", "lard"])
+        self.assertEqual(len(self.blob_requests(m)), 1)
+    def test_on_disk(self, m):
+        self.mock_repo(m, "upstream")
+        folder = tempfile.mkdtemp()
+        for n in range(2):
+            syg.process_repo("https://api.github.com/repos/upstream/dunno",
+                "https://github.com/upstream/dunno", "upstream", "dunno",
+                syg.Client(blobs=syg.BlobCache(folder)))
+        self.assertEqual(len(self.blob_requests(m)), 1)
+    def test_wrong_content_not_cached(self, m):
+        blobs = syg.BlobCache()
+        blobs.put("0" * 40, b"nope")
+        self.assertEqual(blobs.get("0" * 40), None)
+    def test_size_cap(self, m):
+        blobs = syg.BlobCache(tempfile.mkdtemp(), max_bytes=1000, memory_bytes=500)
+        contents = [(b"%d" % n) * 200 for n in range(10)]
+        for content in contents:
+            blobs.put(syg.git_blob_sha(content), content)
+        self.assertLessEqual(sum(e[1] for e in blobs.disk.entries()), 1000)
+        self.assertLessEqual(blobs.memory_size, 500)
+        self.assertEqual(blobs.get(syg.git_blob_sha(contents[-1])), contents[-1])
+        self.assertEqual(blobs.get(syg.git_blob_sha(contents[0])), None)
+    def test_parsed_memoized(self, m):
+        calls = []
+        def parse(content):
+            calls.append(content)
+            return len(content)
+        self.assertEqual(syg.parsed_blob("test", b"abc", parse), 3)
+        self.assertEqual(syg.parsed_blob("test", b"abc", parse), 3)
+        self.assertEqual(len(calls), 1)
+
+class TestPipeline(unittest.TestCase):
+    def make_handler(self, name, log, delay=0, **kwargs):
+        def h(snap, repo, filenames, tree_getter, file_getter, client):
+            log.append(("start", name))
+            time.sleep(delay)
+            for key in kwargs.get("provides") or [name]:
+                snap[key] = len(log)
+            log.append(("end", name))
+        h.__name__ = name
+        syg.handler(always=True, **kwargs)(h)
+        syg.HANDLERS.remove(h)
+        return h
+
+    def run_handlers(self, handlers):
+        return syg.run_handlers(handlers, {}, syg.TreeIndex(), None, None)
+
+    def test_independent_overlap(self):
+        log = []
+        handlers = [self.make_handler("a", log, 0.2, requires=[], provides=["a"]),
+            self.make_handler("b", log, 0.2, requires=[], provides=["b"])]
+        started = time.time()
+        self.run_handlers(handlers)
+        self.assertLess(time.time() - started, 0.35)
+    def test_coroutines_share_loop(self):
+        seen = []
+        def make_coroutine(name, delay):
+            async def h(snap, repo, filenames, tree_getter, file_getter, client):
+                seen.append((asyncio.get_running_loop(), threading.get_ident()))
+                await asyncio.sleep(delay)
+                snap[name] = True
+            h.__name__ = name
+            syg.handler(always=True, requires=[], provides=[name])(h)
+            syg.HANDLERS.remove(h)
+            return h
+        log = []
+        handlers = [make_coroutine("a", 0.2), make_coroutine("b", 0.2),
+            self.make_handler("c", log, 0.2, requires=[], provides=["c"]),
+            make_coroutine("d", 0)]
+        handlers[3].requires = ("a",)
+        started = time.time()
+        output = self.run_handlers(handlers)
+        self.assertLess(time.time() - started, 0.35)
+        self.assertEqual(list(output.keys()), ["a", "b", "c", "d"])
+        self.assertEqual(len(set(seen)), 1)
+        self.assertEqual(seen[0][1], threading.get_ident())
+    def test_dependency_waits(self):
+        log = []
+        handlers = [self.make_handler("a", log, 0.1, requires=[], provides=["a"]),
+            self.make_handler("b", log, 0, requires=["a"], provides=["b"])]
+        self.run_handlers(handlers)
+        self.assertEqual(log, [("start", "a"), ("end", "a"), ("start", "b"), ("end", "b")])
+    def test_same_key_keeps_order(self):
+        log = []
+        handlers = [self.make_handler("a", log, 0.1, requires=[], provides=["x"]),
+            self.make_handler("b", log, 0, requires=[], provides=["x"])]
+        self.run_handlers(handlers)
+        self.assertEqual(log[1], ("end", "a"))
+    def test_undeclared_is_serial(self):
+        log = []
+        handlers = [self.make_handler("a", log, 0.1, requires=[], provides=["a"]),
+            self.make_handler("b", log, 0)]
+        self.run_handlers(handlers)
+        self.assertEqual(log[1], ("end", "a"))
+    def test_provides_only(self):
+        log = []
+        handlers = [self.make_handler("a", log, 0.2, provides=["a"]),
+            self.make_handler("b", log, 0.2, provides=["b"])]
+        started = time.time()
+        output = self.run_handlers(handlers)
+        self.assertLess(time.time() - started, 0.35)
+        self.assertEqual(list(output.keys()), ["a", "b"])
+    def test_requires_only(self):
+        log = []
+        handlers = [self.make_handler("a", log, 0.1, requires=[], provides=["a"]),
+            self.make_handler("b", log, 0.3, requires=[], provides=["b"]),
+            self.make_handler("c", log, 0, requires=["a"])]
+        self.assertEqual(handlers[2].provides, ())
+        self.run_handlers(handlers)
+        # c waits for a, but not for b
+        self.assertLess(log.index(("end", "a")), log.index(("start", "c")))
+        self.assertLess(log.index(("end", "c")), log.index(("end", "b")))
+    def test_key_order(self):
+        # version finishes first, but still comes after the basic keys
+        log = []
+        handlers = [self.make_handler("basic", log, 0.1, requires=[], provides=["name", "parts"]),
+            self.make_handler("version", log, 0, requires=[], provides=["version"])]
+        output = self.run_handlers(handlers)
+        self.assertEqual(log[2], ("end", "version"))
+        self.assertEqual(list(output.keys()), ["name", "parts", "version"])
+    def test_declared_dependencies(self):
+        self.assertFalse(syg.handler_conflicts(syg.HandlerBasic, syg.HandlerVersion))
+        self.assertTrue(syg.handler_conflicts(syg.HandlerBasic, syg.HandlerDebian))
+        self.assertTrue(syg.handler_conflicts(syg.HandlerMake, syg.HandlerDebian))
+        self.assertFalse(syg.handler_conflicts(syg.HandlerVersion, syg.HandlerDebian))
+
 class TestSerialiser(unittest.TestCase):
     def test_basic(self):
         self.assertEqual(
             syg.serialise({"name": "myname", "pies": "many"}),
             "name: myname\npies: many\n"
             )
+    def test_ordered(self):
+        snap = collections.OrderedDict([("pies", "many"), ("name", "myname")])
+        self.assertEqual(syg.serialise(snap), "pies: many\nname: myname\n")
+        self.assertNotIn(collections.OrderedDict, yaml.SafeDumper.yaml_representers)
+    def test_to_file(self):
+        fp = io.StringIO()
+        self.assertIsNone(syg.serialise({"name": "myname"}, fp))
+        self.assertEqual(fp.getvalue(), "name: myname\n")
+    def test_yaml_stream(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            writer = syg.StreamWriter("-")
+            writer.write("https://github.com/a/one", "a", "one", {"name": "one"})
+            writer.error("https://github.com/a/two", "HTTP 500\nfetching")
+            writer.write("https://github.com/a/three", "a", "three", {"name": "three"})
+            writer.close()
+        self.assertEqual([d["name"] for d in yaml.safe_load_all(out.getvalue())], ["one", "three"])
+        self.assertIn("# error: https://github.com/a/two: HTTP 500 fetching\n", out.getvalue())
+    def test_jsonl_stream(self):
+        path = os.path.join(tempfile.mkdtemp(), "out.jsonl")
+        writer = syg.StreamWriter(path, "jsonl")
+        writer.write("https://github.com/a/one", "a", "one", {"name": "one"})
+        writer.error("https://github.com/a/two", "HTTP 500")
+        writer.close()
+        with open(path) as fp:
+            self.assertEqual([json.loads(line) for line in fp], [
+                {"repo": "https://github.com/a/one", "snap": {"name": "one"}},
+                {"repo": "https://github.com/a/two", "error": "HTTP 500"}])
 
 @requests_mock.mock()
 class TestTreeGetter(unittest.TestCase):
     def basic_request(self, m):
-        m.get("internal://trees/strange/subdir", text=json.dumps({
-            "tree": [{"path": "subsubdir", "url": "internal://trees/strange/subdir/subsubdir", "type": "tree"}]
-        }))
-        m.get("internal://trees/strange/subdir/subsubdir", text=json.dumps({
-            "tree": [{"path": "pies", "url": "internal://trees/strange/subdir/subsubdir/pies", "type": "blob"}]
+        m.get("internal://trees/strange?recursive=1", text=json.dumps({
+            "tree": [
+                {"path": "subdir", "url": "internal://trees/strange/subdir", "type": "tree"},
+                {"path": "subdir/subsubdir", "url": "internal://trees/strange/subdir/subsubdir", "type": "tree"},
+                {"path": "subdir/subsubdir/pies", "url": "internal://trees/strange/subdir/subsubdir/pies", "type": "blob"}
+            ]
         }))
-        initial_trees = {
-            "tree": [{"path": "subdir", "url": "internal://trees/strange/subdir", "type": "tree"}]
-        }
-        tg = syg.get_tree_getter(initial_trees)
+        index = syg.fetch_tree("internal://trees/strange", syg.Client())
+        tg = syg.get_tree_getter(index)
         result = tg(["subdir", "subsubdir"])
         return result
 
-    def test_called_three(self, m):
+    def test_called_once(self, m):
         output = self.basic_request(m)
-        self.assertEqual(m.call_count, 2)
+        self.assertEqual(m.call_count, 1)
     def test_output_count(self, m):
         output = self.basic_request(m)
         self.assertEqual(len(output), 1)
     def test_output_path(self, m):
         output = self.basic_request(m)
         self.assertEqual(output[0], "pies")
+    def test_missing(self, m):
+        m.get("internal://trees/strange?recursive=1", text=json.dumps({"tree": []}))
+        tg = syg.get_tree_getter(syg.fetch_tree("internal://trees/strange", syg.Client()))
+        self.assertEqual(tg(["nope"]), [])
+
+@requests_mock.mock()
+class TestTruncatedTree(unittest.TestCase):
+    def basic_request(self, m):
+        m.get("internal://trees/root?recursive=1", text=json.dumps({
+            "tree": [{"path": "a", "url": "internal://trees/a", "type": "tree"}],
+            "truncated": True
+        }))
+        m.get("internal://trees/root", complete_qs=True, text=json.dumps({
+            "tree": [
+                {"path": "a", "url": "internal://trees/a", "type": "tree"},
+                {"path": "b", "url": "internal://trees/b", "type": "tree"},
+                {"path": "Makefile", "type": "blob"}
+            ]
+        }))
+        m.get("internal://trees/a?recursive=1", text=json.dumps({
+            "tree": [{"path": "one.c", "type": "blob"}]
+        }))
+        m.get("internal://trees/b?recursive=1", text=json.dumps({
+            "tree": [{"path": "c", "url": "internal://trees/c", "type": "tree"}],
+            "truncated": True
+        }))
+        m.get("internal://trees/b", complete_qs=True, text=json.dumps({
+            "tree": [{"path": "c", "url": "internal://trees/c", "type": "tree"}]
+        }))
+        m.get("internal://trees/c?recursive=1", text=json.dumps({
+            "tree": [{"path": "control", "type": "blob"}]
+        }))
+        return syg.fetch_tree("internal://trees/root", syg.Client())
+
+    def test_root(self, m):
+        index = self.basic_request(m)
+        self.assertEqual(index.listdir(""), ["a", "b", "Makefile"])
+    def test_deep(self, m):
+        index = self.basic_request(m)
+        self.assertEqual(index.listdir("a"), ["one.c"])
+        self.assertIn("b/c/control", index)
+    def test_called(self, m):
+        self.basic_request(m)
+        self.assertEqual(m.call_count, 6)
+
+class TestStreamedListing(unittest.TestCase):
+    LISTING = {"sha": "abc", "url": "internal://trees/abc", "tree": [
+        {"path": "caf\u00e9/Makefile", "type": "blob", "sha": "1"},
+        {"path": "x", "type": "tree", "sha": "2"}
+    ], "truncated": True}
+
+    def chunks(self, text, size):
+        data = text.encode("utf-8")
+        return [data[n:n + size] for n in range(0, len(data), size)]
+
+    def test_small_chunks(self):
+        for separators in ((",", ":"), (", ", ": ")):
+            text = json.dumps(self.LISTING, separators=separators)
+            for size in (1, 7, 1000):
+                listing = syg.StreamedListing(self.chunks(text, size))
+                self.assertEqual(list(listing.get("tree")), self.LISTING["tree"])
+                self.assertEqual(listing.get("truncated"), True)
+                self.assertEqual(listing.get("sha"), "abc")
+    def test_tree_first(self):
+        listing = syg.StreamedListing(self.chunks('{"tree": [], "truncated": false}', 5))
+        self.assertEqual(list(listing.get("tree")), [])
+        self.assertEqual(listing.get("truncated"), False)
+    def test_cut_short(self):
+        listing = syg.StreamedListing(self.chunks('{"tree": [{"path": "a"}, {"pa', 5))
+        self.assertRaises(ValueError, list, listing.get("tree"))
+
+@requests_mock.mock()
+class TestMonorepo(unittest.TestCase):
+    def basic_request(self, m, top=()):
+        files = ["README.md", "cli/CMakeLists.txt", "cli/lib/CMakeLists.txt", "cli/main.c",
+            "daemon/Makefile", "daemon/tests/requirements.txt", "py/requirements.txt",
+            "tools/gui/app.pro"] + list(top)
+        m.get("https://api.github.com/repos/acme/mono", text=json.dumps({
+            "name": "mono",
+            "clone_url": "https://github.com/acme/mono.git",
+            "trees_url": "internal://trees{/sha}",
+            "default_branch": "master"
+        }))
+        m.get("internal://trees/master?recursive=1", text=json.dumps({"sha": "master",
+            "tree": [{"path": f, "type": "blob", "sha": f, "mode": "100644"} for f in files],
+            "truncated": False}))
+        return syg.process_monorepo("https://api.github.com/repos/acme/mono",
+            "https://github.com/acme/mono", "acme", "mono", syg.Client())
+
+    def test_roots(self, m):
+        index = syg.BuildFileIndex()
+        for path in ("Makefile", "src/x.c", "a/CMakeLists.txt", "a/b/CMakeLists.txt", "a/b/Makefile"):
+            index.add(path, {"type": "blob", "sha": path})
+        self.assertNotIn("src/x.c", index)
+        self.assertEqual([(f, [h.__name__ for h in hs]) for f, hs in index.build_roots()],
+            [("", ["HandlerMake"]), ("a", ["HandlerCmake"])])
+    def test_parts(self, m):
+        snap = self.basic_request(m)
+        self.assertEqual(sorted(snap["parts"]), ["cli", "daemon", "daemon-tests", "py", "tools-gui"])
+        self.assertEqual(snap["parts"]["cli"]["plugin"], "cmake")
+        self.assertEqual(snap["parts"]["tools-gui"]["plugin"], "qmake")
+        self.assertEqual(snap["parts"]["daemon-tests"]["source-subdir"], "daemon/tests")
+        self.assertEqual(snap["parts"]["py"]["source"], "https://github.com/acme/mono.git")
+        self.assertIn("opengl", snap["apps"]["mono"]["plugs"])
+    def test_top_level_part(self, m):
+        snap = self.basic_request(m, top=["Makefile"])
+        self.assertEqual(snap["parts"]["mono"], {"plugin": "make"})
+        self.assertNotIn("daemon", snap["parts"])
+    def test_part_name(self, m):
+        self.assertEqual(syg.part_name("Tools/CLI_v2", set()), "tools-cli-v2")
+        self.assertEqual(syg.part_name("a/b", set(["a-b"])), "a-b-2")
 
 @requests_mock.mock()
 class TestFileGetter(unittest.TestCase):
@@ -322,6 +965,557 @@ class TestFileGetter(unittest.TestCase):
         tg = syg.get_file_getter("internal://base/repos/mrtest/myrepo", {}, "mrtest", "myrepo")
         result = tg("fname")
         self.assertEqual(result, b"ahaha")
+    def test_missing(self, m):
+        m.get("https://api.github.com/repos/mrtest/myrepo/contents/fname", status_code=404,
+            text=json.dumps({"message": "Not Found"}))
+        tg = syg.get_file_getter("internal://base/repos/mrtest/myrepo", {}, "mrtest", "myrepo")
+        self.assertRaises(syg.SygHTTPException, tg, "fname")
+    def test_blob_server_error(self, m):
+        m.get("https://api.github.com/repos/mrtest/myrepo/git/blobs/abc", status_code=502,
+            text="<html>Bad Gateway</html>")
+        index = syg.TreeIndex()
+        index.add("fname", {"type": "blob", "sha": "abc"})
+        tg = syg.get_file_getter("internal://base/repos/mrtest/myrepo", index, "mrtest", "myrepo",
+            syg.Client())
+        self.assertRaises(syg.SygHTTPException, tg, "fname")
+
+@requests_mock.mock()
+class TestClient(unittest.TestCase):
+    def basic_request(self, m):
+        m.get("https://api.github.com/repos/madeup1/madeup2", text=json.dumps({
+            "name": "dunno",
+            "trees_url": "internal://trees{/sha}",
+            "releases_url": "internal://releases{/id}"
+        }))
+        m.get("internal://trees/master", text=json.dumps({"tree": []}))
+        m.get("internal://releases/latest", text=json.dumps({"tag_name": "1.0"}))
+        client = syg.Client(token="sekrit")
+        return syg.process_repo("https://api.github.com/repos/madeup1/madeup2",
+            "https://github.com/madeup1/madeup2", "madeup1", "madeup2", client)
+
+    def test_headers_everywhere(self, m):
+        self.basic_request(m)
+        self.assertEqual(m.call_count, 3)
+        for req in m.request_history:
+            self.assertEqual(req.headers["user-agent"], syg.HEADERS["user-agent"])
+    def test_token_everywhere(self, m):
+        self.basic_request(m)
+        for req in m.request_history:
+            self.assertEqual(req.headers["Authorization"], "token sekrit")
+    def test_timeout(self, m):
+        self.basic_request(m)
+        self.assertEqual(m.request_history[0].timeout, 30)
+    def test_pool_and_retries(self, m):
+        client = syg.Client(pool_size=4, retries=5)
+        adapter = client.session.get_adapter("https://api.github.com/")
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 5)
+        self.assertIn(502, adapter.max_retries.status_forcelist)
+
+@requests_mock.mock()
+class TestResponseCache(unittest.TestCase):
+    URL = "https://api.github.com/repos/madeup1/madeup2"
+    def basic_request(self, m, **kwargs):
+        m.get(self.URL, [
+            {"text": json.dumps({"name": "dunno"}), "headers": {"ETag": '"abc"'}},
+            {"status_code": 304, "headers": {"ETag": '"abc"'}}
+        ])
+        client = syg.Client(cache=syg.ResponseCache(tempfile.mkdtemp(), **kwargs))
+        first = client.get(self.URL)
+        second = client.get(self.URL)
+        return first, second
+
+    def test_conditional(self, m):
+        self.basic_request(m)
+        self.assertNotIn("If-None-Match", m.request_history[0].headers)
+        self.assertEqual(m.request_history[1].headers["If-None-Match"], '"abc"')
+    def test_304_served_from_cache(self, m):
+        first, second = self.basic_request(m)
+        self.assertFalse(first.from_cache)
+        self.assertTrue(second.from_cache)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), {"name": "dunno"})
+    def test_ttl(self, m):
+        self.basic_request(m, ttl=-1)
+        self.assertNotIn("If-None-Match", m.request_history[1].headers)
+    def test_no_validators_not_cached(self, m):
+        m.get(self.URL, text="{}")
+        cache = syg.ResponseCache(tempfile.mkdtemp())
+        syg.Client(cache=cache).get(self.URL)
+        self.assertEqual(cache.lookup(self.URL), None)
+    def test_eviction(self, m):
+        cache = syg.ResponseCache(tempfile.mkdtemp(), max_bytes=1000)
+        client = syg.Client(cache=cache)
+        for n in range(10):
+            m.get("internal://blob/%d" % n, text="x" * 300, headers={"ETag": '"%d"' % n})
+            client.get("internal://blob/%d" % n)
+        self.assertLessEqual(sum(e[1] for e in cache.entries()), 1000)
+        self.assertNotEqual(cache.lookup("internal://blob/9"), None)
+        self.assertEqual(cache.lookup("internal://blob/0"), None)
+
+@requests_mock.mock()
+class TestRateLimiter(unittest.TestCase):
+    URL = "https://api.github.com/repos/madeup1/madeup2"
+    def test_retry_after(self, m):
+        m.get(self.URL, [
+            {"status_code": 403, "headers": {"Retry-After": "0"}, "text": "{}"},
+            {"text": json.dumps({"name": "dunno"})}
+        ])
+        r = syg.Client().get(self.URL)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(m.call_count, 2)
+    def test_exhausted_waits_for_reset(self, m):
+        reset = time.time() + 0.3
+        m.get(self.URL, [
+            {"status_code": 403, "text": "{}", "headers": {"X-RateLimit-Remaining": "0",
+                "X-RateLimit-Limit": "60", "X-RateLimit-Reset": str(reset - 1)}},
+            {"text": "{}", "headers": {"X-RateLimit-Remaining": "59"}}
+        ])
+        r = syg.Client().get(self.URL)
+        self.assertEqual(r.status_code, 200)
+        self.assertGreaterEqual(time.time(), reset - 0.05)
+    def test_budget_tracked(self, m):
+        m.get(self.URL, text="{}", headers={"X-RateLimit-Remaining": "42",
+            "X-RateLimit-Limit": "60", "X-RateLimit-Reset": str(time.time() + 100)})
+        client = syg.Client()
+        client.get(self.URL)
+        self.assertEqual(client.limiter.remaining, 42)
+        self.assertEqual(client.limiter.projected_seconds(40), 0)
+        self.assertGreater(client.limiter.projected_seconds(100), 90)
+        self.assertGreater(client.limiter.projected_seconds(200), 3600)
+    def test_error_not_empty_repo(self, m):
+        m.get(self.URL, status_code=401, text=json.dumps({"message": "Bad credentials"}))
+        self.assertRaises(syg.SygHTTPException, syg.process_repo, self.URL,
+            "https://github.com/madeup1/madeup2", "madeup1", "madeup2", syg.Client())
+    def test_404(self, m):
+        m.get(self.URL, status_code=404, text=json.dumps({"message": "Not Found"}))
+        self.assertRaises(syg.SygRepoNotFoundException, syg.process_repo, self.URL,
+            "https://github.com/madeup1/madeup2", "madeup1", "madeup2", syg.Client())
+
+    def test_token_bucket(self, m):
+        limiter = syg.RateLimiter(rate=50, burst=1)
+        started = time.time()
+        for n in range(6): limiter.acquire()
+        self.assertGreaterEqual(time.time() - started, 0.09)
+    def test_priority(self, m):
+        limiter = syg.RateLimiter(rate=5, burst=1)
+        limiter.acquire()
+        order = []
+        def take(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+        late = threading.Thread(target=take, args=(5,))
+        late.start()
+        time.sleep(0.05)
+        early = threading.Thread(target=take, args=(1,))
+        early.start()
+        late.join()
+        early.join()
+        self.assertEqual(order, [1, 5])
+
+@requests_mock.mock()
+class TestProfile(unittest.TestCase):
+    def basic_request(self, m, client=None, status=200):
+        m.get("https://api.github.com/repos/madeup1/madeup2", status_code=status, text=json.dumps({
+            "name": "dunno",
+            "trees_url": "internal://trees{/sha}",
+            "releases_url": "internal://releases{/id}"
+        }), headers={"ETag": '"repo"'})
+        m.get("internal://trees/master", text=json.dumps({"tree": [{"path": "Makefile"}]}))
+        m.get("internal://releases/latest", text=json.dumps({"tag_name": "1.0"}))
+        profile = syg.Profile()
+        client = client or syg.Client()
+        with client.using(profile=profile):
+            syg.process_repo("https://api.github.com/repos/madeup1/madeup2",
+                "https://github.com/madeup1/madeup2", "madeup1", "madeup2", client)
+        return profile
+
+    def test_requests(self, m):
+        profile = self.basic_request(m)
+        self.assertEqual(sorted(r["url"] for r in profile.requests), [
+            "https://api.github.com/repos/madeup1/madeup2",
+            "internal://releases/latest",
+            "internal://trees/master?recursive=1"])
+        self.assertTrue(all(r["status"] == 200 and r["bytes"] > 0 for r in profile.requests))
+    def test_handlers(self, m):
+        profile = self.basic_request(m)
+        self.assertEqual(sorted(h["handler"] for h in profile.handlers),
+            ["HandlerBasic", "HandlerMake", "HandlerVersion"])
+    def test_cache_hits(self, m):
+        client = syg.Client(cache=syg.ResponseCache(tempfile.mkdtemp()))
+        self.basic_request(m, client)
+        profile = self.basic_request(m, client, 304)
+        self.assertEqual(profile.trace()["summary"]["cached"], 1)
+    def test_write_profile(self, m):
+        path = os.path.join(tempfile.mkdtemp(), "trace.json")
+        syg.write_profile(path, {"one": self.basic_request(m), "two": self.basic_request(m)})
+        with open(path) as fp:
+            trace = json.load(fp)
+        self.assertEqual(list(trace["repos"].keys()), ["one", "two"])
+        self.assertEqual(trace["summary"]["requests"], 6)
+        self.assertEqual(trace["summary"]["handlers"]["HandlerMake"]["calls"], 2)
+    def test_streamed(self, m):
+        listing = json.dumps({"tree": [{"path": "x%d" % i} for i in range(1000)]}).encode("utf-8")
+        m.get("internal://trees/big", body=io.BytesIO(listing))
+        profile = syg.Profile()
+        client = syg.Client()
+        with client.using(profile=profile):
+            streamed = syg.stream_listing(client, "internal://trees/big")
+            self.assertEqual(profile.requests, [])
+            self.assertEqual(len(list(streamed.get("tree"))), 1000)
+        self.assertEqual([r["bytes"] for r in profile.requests], [len(listing)])
+    def test_local(self, m):
+        profile = syg.Profile()
+        syg.process_local(LocalFixture().make_tree(), profile)
+        self.assertEqual(sorted(h["handler"] for h in profile.handlers),
+            ["HandlerBasic", "HandlerDebian", "HandlerMake", "HandlerVersion"])
+
+@requests_mock.mock()
+class TestIncremental(unittest.TestCase):
+    API = "https://api.github.com/repos/madeup1/madeup2"
+    def setUp(self):
+        self.state = syg.StateStore(tempfile.mkdtemp())
+
+    def basic_request(self, m, tree_sha="t1", tag="1.0", plugin_file="Makefile"):
+        m.get(self.API, text=json.dumps({
+            "name": "dunno",
+            "trees_url": "internal://trees{/sha}",
+            "releases_url": self.API + "/releases{/id}"
+        }))
+        m.get("internal://trees/master", text=json.dumps({"tree": [{"path": plugin_file},
+            {"path": "debian", "type": "tree"}, {"path": "debian/control", "type": "blob"}]}))
+        m.get(self.API + "/contents/debian/control", text=json.dumps({
+            "content": base64.b64encode(b"Source: x\nBuild-Depends: lard\n").decode("utf-8")
+        }))
+        m.get(self.API + "/releases/latest", text=json.dumps({"tag_name": tag}))
+        m.get(self.API + "/commits/HEAD", text=json.dumps({"commit": {"tree": {"sha": tree_sha}}}))
+        m.reset_mock()
+        return syg.process_one("https://github.com/madeup1/madeup2", syg.Client(), state=self.state)[2]
+
+    def test_first_run(self, m):
+        output = self.basic_request(m)
+        self.assertEqual(output["parts"]["dunno"]["plugin"], "make")
+        self.assertEqual(m.call_count, 6)
+    def test_unchanged(self, m):
+        first = self.basic_request(m)
+        second = self.basic_request(m)
+        self.assertEqual(syg.serialise(second), syg.serialise(first))
+        self.assertEqual(sorted(r.url for r in m.request_history),
+            [self.API + "/commits/HEAD", self.API + "/releases/latest"])
+    def test_tree_moved(self, m):
+        self.basic_request(m)
+        output = self.basic_request(m, tree_sha="t2", plugin_file="configure.ac")
+        self.assertEqual(output["parts"]["dunno"]["plugin"], "autotools")
+        self.assertEqual(m.call_count, 6)
+    def test_packages_index_changed(self, m):
+        self.basic_request(m)
+        path = os.path.join(tempfile.mkdtemp(), "index")
+        syg.PackageIndex.build(["/dev/null"], path)
+        old_index, syg.PACKAGE_INDEX = syg.PACKAGE_INDEX, syg.PackageIndex(path)
+        try:
+            self.basic_request(m)
+            self.assertEqual(m.call_count, 6)
+            self.basic_request(m)
+            self.assertEqual(m.call_count, 2)
+        finally:
+            syg.PACKAGE_INDEX.close()
+            syg.PACKAGE_INDEX = old_index
+    def test_release_moved(self, m):
+        self.basic_request(m)
+        output = self.basic_request(m, tag="2.0")
+        self.assertEqual(output["version"], "2.0")
+    def test_no_releases(self, m):
+        self.basic_request(m)
+        m.get(self.API + "/releases/latest", status_code=404, text="{}")
+        self.assertEqual(syg.current_version(self.API, "madeup1", "madeup2", syg.Client()), ("t1", None))
+
+@requests_mock.mock()
+class TestBatch(unittest.TestCase):
+    def mock_repo(self, m, owner, name):
+        m.get("https://api.github.com/repos/%s/%s" % (owner, name), text=json.dumps({
+            "name": name,
+            "trees_url": "internal://%s/trees{/sha}" % (owner,),
+            "default_branch": "master"
+        }))
+        m.get("internal://%s/trees/master" % (owner,), text=json.dumps({
+            "tree": [{"path": "Makefile"}]
+        }))
+
+    def basic_request(self, m):
+        self.mock_repo(m, "one", "first")
+        self.mock_repo(m, "two", "second")
+        m.get("https://api.github.com/repos/three/missing", text=json.dumps({
+            "message": "Not Found"
+        }))
+        self.outdir = tempfile.mkdtemp()
+        urls = syg.read_repo_list(io.StringIO(
+            "https://github.com/one/first\n"
+            "# a comment\n"
+            "\n"
+            "https://github.com/three/missing\n"
+            "not-a-url\n"
+            "https://github.com/two/second.git\n"))
+        self.progress = []
+        return syg.process_batch(urls, self.outdir, workers=2, total=4,
+            progress=lambda *args: self.progress.append(args))
+
+    def test_all_reported(self, m):
+        output = self.basic_request(m)
+        self.assertEqual(len(output), 4)
+    def test_failures_isolated(self, m):
+        output = self.basic_request(m)
+        self.assertEqual(sorted(r[0] for r in output if r[1]),
+            ["https://github.com/one/first", "https://github.com/two/second.git"])
+    def test_files_written(self, m):
+        self.basic_request(m)
+        with open(os.path.join(self.outdir, "two", "second", "snapcraft.yaml")) as fp:
+            self.assertIn("plugin: make", fp.read())
+    def test_progress(self, m):
+        self.basic_request(m)
+        self.assertEqual([p[0] for p in self.progress], [1, 2, 3, 4])
+        self.assertEqual(self.progress[-1][2], 0)
+    def test_duration(self, m):
+        self.assertEqual(syg.format_duration(59.9), "00:00:59")
+        self.assertEqual(syg.format_duration(30 * 3600), "1d 06:00:00")
+    def test_profiles(self, m):
+        self.mock_repo(m, "one", "first")
+        profiles = {}
+        syg.process_batch(["https://github.com/one/first"], tempfile.mkdtemp(), profiles=profiles)
+        self.assertEqual(len(profiles["https://github.com/one/first"].requests), 2)
+    def test_summary(self, m):
+        self.basic_request(m)
+        with open(os.path.join(self.outdir, "summary.txt")) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(len([l for l in lines if l.startswith("error\t")]), 2)
+
+@requests_mock.mock()
+class TestOrgScan(unittest.TestCase):
+    def basic_request(self, m):
+        for owner, name in (("acme", "first"), ("acme", "second"), ("acme", "third")):
+            TestBatch.mock_repo(self, m, owner, name)
+        m.get("https://api.github.com/orgs/acme/repos?per_page=100&type=all",
+            text=json.dumps([{"html_url": "https://github.com/acme/first"},
+                {"html_url": "https://github.com/acme/second"}]),
+            headers={"Link": '<https://api.github.com/organizations/1/repos?page=2>; rel="next"'})
+        m.get("https://api.github.com/organizations/1/repos?page=2",
+            text=json.dumps([{"html_url": "https://github.com/acme/third"}]))
+        self.outdir = tempfile.mkdtemp()
+
+    def test_pages(self, m):
+        self.basic_request(m)
+        self.assertEqual(list(syg.owner_repos("acme", syg.Client())), [
+            "https://github.com/acme/first", "https://github.com/acme/second",
+            "https://github.com/acme/third"])
+    def test_user(self, m):
+        m.get("https://api.github.com/orgs/someone/repos?per_page=100&type=all", status_code=404)
+        m.get("https://api.github.com/users/someone/repos?per_page=100&type=owner",
+            text=json.dumps([{"html_url": "https://github.com/someone/thing"}]))
+        self.assertEqual(list(syg.owner_repos("someone", syg.Client())),
+            ["https://github.com/someone/thing"])
+    def test_no_such_owner(self, m):
+        m.get("https://api.github.com/orgs/nobody/repos?per_page=100&type=all", status_code=404)
+        m.get("https://api.github.com/users/nobody/repos?per_page=100&type=owner", status_code=404)
+        self.assertRaises(syg.SygRepoNotFoundException, list, syg.owner_repos("nobody", syg.Client()))
+    def test_jsonl(self, m):
+        self.basic_request(m)
+        path = os.path.join(self.outdir, "out.jsonl")
+        self.assertEqual(syg.cli(["--org", "acme", "--output", path, "--format", "jsonl"]), 0)
+        with open(path) as fp:
+            lines = [json.loads(line) for line in fp]
+        self.assertEqual(sorted(l["repo"] for l in lines), [
+            "https://github.com/acme/first", "https://github.com/acme/second",
+            "https://github.com/acme/third"])
+        self.assertEqual(lines[0]["snap"]["parts"][lines[0]["repo"].split("/")[-1]]["plugin"], "make")
+    def test_resume(self, m):
+        self.basic_request(m)
+        checkpoint = os.path.join(self.outdir, "checkpoint")
+        with open(checkpoint, "w") as fp:
+            fp.write('{"repo": "https://github.com/acme/first", "ok": true}\n')
+            fp.write('{"repo": "https://github.com/acme/second", "ok": false}\n')
+            fp.write('{"repo": "https://github.com/acme/th') # killed mid-write
+        results = syg.process_batch(syg.owner_repos("acme", syg.Client()), self.outdir,
+            checkpoint=syg.Checkpoint(checkpoint))
+        self.assertEqual(sorted(r[0] for r in results),
+            ["https://github.com/acme/second", "https://github.com/acme/third"])
+        self.assertEqual(len(syg.Checkpoint(checkpoint).done), 3)
+    def resume_twice(self, m, output, *args):
+        # acme/second fails the first time, and is tried again and works the second
+        self.basic_request(m)
+        m.get("https://api.github.com/repos/acme/second", status_code=403, text="{}")
+        argv = ["--org", "acme", "--output", output,
+            "--checkpoint", os.path.join(self.outdir, "checkpoint")] + list(args)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(syg.cli(argv), 3)
+            TestBatch.mock_repo(self, m, "acme", "second")
+            self.assertEqual(syg.cli(argv), 0)
+    def test_resume_stream(self, m):
+        path = os.path.join(tempfile.mkdtemp(), "out.jsonl")
+        self.resume_twice(m, path, "--format", "jsonl")
+        with open(path) as fp:
+            lines = [json.loads(line) for line in fp]
+        last = dict((l["repo"], l) for l in lines)
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(len(last), 3)
+        self.assertTrue(all("snap" in l for l in last.values()))
+    def test_resume_summary(self, m):
+        outdir = tempfile.mkdtemp()
+        self.resume_twice(m, outdir)
+        with open(os.path.join(outdir, "summary.txt")) as fp:
+            lines = [l.split("\t")[:2] for l in fp.read().splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(sorted(set(l[1] for l in lines)), [
+            "https://github.com/acme/first", "https://github.com/acme/second",
+            "https://github.com/acme/third"])
+        self.assertEqual(lines[-1], ["ok", "https://github.com/acme/second"])
+
+class TestArguments(unittest.TestCase):
+    def test_no_args(self):
+        self.assertRaises(syg.SygSyntaxException, syg.parse_args, [])
+    def test_url_and_batch(self):
+        self.assertRaises(syg.SygSyntaxException, syg.parse_args,
+            ["https://github.com/a/b", "--batch", "-"])
+    def test_url_and_local(self):
+        self.assertRaises(syg.SygSyntaxException, syg.parse_args,
+            ["https://github.com/a/b", "--local", "."])
+    def test_bad_backend(self):
+        self.assertRaises(syg.SygSyntaxException, syg.parse_args,
+            ["https://github.com/a/b", "--backend", "carrier-pigeon"])
+    def test_batch_format_needs_output(self):
+        self.assertRaises(syg.SygSyntaxException, syg.parse_args,
+            ["--batch", "list.txt", "--format", "jsonl"])
+        self.assertEqual(syg.parse_args(["--batch", "list.txt", "--format", "jsonl",
+            "--output", "-"]).output, "-")
+        self.assertEqual(syg.parse_args(["--batch", "list.txt"]).output, ".")
+    def test_file_error_reported(self):
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertEqual(syg.cli(["--batch", "/nonexistent/list.txt"]), 2)
+        self.assertIn("Error: ", err.getvalue())
+    def test_checkpoint_needs_batch(self):
+        self.assertRaises(syg.SygSyntaxException, syg.parse_args,
+            ["https://github.com/a/b", "--checkpoint", "done.jsonl"])
+    def test_batch(self):
+        args = syg.parse_args(["--batch", "-", "--workers", "3"])
+        self.assertEqual(args.batch, "-")
+        self.assertEqual(args.workers, 3)
+
+class TestStartup(unittest.TestCase):
+    # microseconds for "import syg", compiled; a few ms is usual, and well
+    # over 100ms if requests, yaml and deb822 get imported up front again
+    IMPORT_BUDGET = 50000
+    def python(self, *args):
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=tempfile.gettempdir() + "/syg-pycache")
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        return subprocess.run((sys.executable,) + args, env=env, check=True, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_import_time(self):
+        self.python("-c", "import syg")
+        times = []
+        for attempt in range(3):
+            lines = self.python("-X", "importtime", "-c", "import syg").stderr.splitlines()
+            times.append(int([l for l in lines if l.endswith("| syg")][0].split("|")[1]))
+        self.assertLess(min(times), self.IMPORT_BUDGET)
+    def test_lazy_modules(self):
+        # against what the interpreter (and site) loads anyway
+        modules = "import sys%s; print(' '.join(sorted(sys.modules)))"
+        loaded = set(self.python("-c", modules % ", syg").stdout.split())
+        loaded -= set(self.python("-c", modules % "").stdout.split())
+        for name in ("requests", "yaml", "deb822", "debian", "asyncio", "concurrent.futures",
+                "http.server", "tarfile", "zipfile", "subprocess"):
+            self.assertNotIn(name, loaded)
+    def test_local_without_requests(self):
+        folder = tempfile.mkdtemp()
+        open(os.path.join(folder, "Makefile"), "w").close()
+        output = os.path.join(folder, "snapcraft.yaml")
+        p = self.python("-c", "import sys, syg; status = syg.cli(['--local', %r, '--output', %r]); "
+            "print(status, 'requests' in sys.modules)" % (folder, output))
+        self.assertEqual(p.stdout.split(), ["0", "False"])
+        self.assertTrue(os.path.exists(output))
+    def test_usage_error(self):
+        p = subprocess.run((sys.executable, "syg.py"), cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(p.returncode, 1)
+        self.assertIn("Usage: syg", p.stderr)
+
+class TestBenchmark(unittest.TestCase):
+    # the quick scenarios, without injected latency, against a real local server
+    def setUp(self):
+        self.fake = bench.FakeGitHub().start()
+        self.old_api_url, syg.API_URL = syg.API_URL, self.fake.url
+    def tearDown(self):
+        syg.API_URL = self.old_api_url
+        self.fake.stop()
+
+    def test_tiny(self):
+        result = bench.measure(self.fake, "tiny")
+        self.assertEqual(bench.over_budget(result), [])
+    def test_typical(self):
+        result = bench.measure(self.fake, "typical")
+        self.assertEqual(bench.over_budget(result), [])
+    def test_archive(self):
+        result = bench.measure(self.fake, "typical-archive")
+        self.assertEqual(bench.over_budget(result), [])
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.fake = bench.FakeGitHub(latency=0.05).start()
+        self.old_api_url, syg.API_URL = syg.API_URL, self.fake.url
+        self.repourl = self.fake.add(bench.typical())
+        self.server = syg.make_server("127.0.0.1", 0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/generate" % (self.server.server_address[1],)
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        syg.API_URL = self.old_api_url
+        self.fake.stop()
+
+    def generate(self, repourl):
+        return requests.get(self.url, params={"repo": repourl})
+
+    def test_generate(self):
+        r = self.generate(self.repourl)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("plugin: cmake", r.text)
+        self.assertIn("- debhelper", r.text)
+    def test_bad_url(self):
+        self.assertEqual(self.generate("nope").status_code, 400)
+    def test_not_found(self):
+        self.assertEqual(self.generate("https://github.com/bench/missing").status_code, 404)
+    def test_warm_cache(self):
+        self.generate(self.repourl)
+        self.fake.reset_counts()
+        self.assertEqual(self.generate(self.repourl).status_code, 200)
+        self.assertEqual(self.fake.not_modified, self.fake.requests)
+    def test_default_backend(self):
+        server = syg.make_server("127.0.0.1", 0, backend="archive")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            r = requests.get("http://127.0.0.1:%d/generate" % (server.server_address[1],),
+                params={"repo": self.repourl})
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("plugin: cmake", r.text)
+        self.assertEqual(self.fake.requests, 3) # repository, release and tarball
+    def test_coalescing(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.generate(self.repourl)))
+            for n in range(5)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual([r.status_code for r in results], [200] * 5)
+        self.assertEqual(len(set(r.text for r in results)), 1)
+        self.assertEqual(self.fake.requests, 4)
+
+class TestCoalescer(unittest.TestCase):
+    def test_exception_shared(self):
+        coalescer = syg.Coalescer()
+        def fail(): raise syg.SygException("no")
+        self.assertRaises(syg.SygException, coalescer.run, "k", fail)
+        self.assertEqual(coalescer.run("k", lambda: 2), 2)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file